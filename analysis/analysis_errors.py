@@ -1,40 +1,33 @@
-import json
+import sys
 from pathlib import Path
 #python -m pip install tabulate
 import pandas as pd
 
 
 BASE = Path(__file__).resolve().parent.parent
-LOG_PATH = BASE / "out" / "vigade_log.csv"
-OUT_DIR = BASE / "out" / "analysis"
-OUT_DIR.mkdir(parents=True, exist_ok=True)
+sys.path.insert(0, str(BASE))
 
+import query_log  # noqa: E402
 
-def safe_json_loads(x: str):
-    try:
-        return json.loads(x) if isinstance(x, str) else {}
-    except Exception:
-        return {}
+QUERY_LOG_DB = BASE / "out" / "query_log.sqlite"
+LOG_PATH = BASE / "out" / "vigade_log.csv"  # old CSV log, used when there is no query_log.sqlite
+OUT_DIR = BASE / "out" / "analysis"
+OUT_DIR.mkdir(parents=True, exist_ok=True)
 
 
 def main():
-    if not LOG_PATH.exists():
-        raise SystemExit(f"Puudub logifail: {LOG_PATH}")
-
-    df = pd.read_csv(LOG_PATH)
-
-    # normaliseeri veeru nimed (kui sul peaksid veidi erinema)
-    required = {"Aeg", "Päring", "Filtrid", "Samm", "Tulemus", "DetailidJSON"}
-    missing = required - set(df.columns)
-    if missing:
-        raise SystemExit(f"Logifailist puuduvad veerud: {sorted(missing)}")
+    # live traffic only (analysis job rows carry a run id)
+    try:
+        df = query_log.load_log(QUERY_LOG_DB, LOG_PATH, live_only=True)
+    except FileNotFoundError:
+        raise SystemExit(f"Puudub logi: {QUERY_LOG_DB} / {LOG_PATH}")
+    log_src = QUERY_LOG_DB if QUERY_LOG_DB.exists() else LOG_PATH
 
     bad = df[df["Tulemus"].astype(str).str.upper() == "BAD"].copy()
 
-    # võta exception + message välja DetailidJSON-ist
-    details = bad["DetailidJSON"].apply(safe_json_loads)
-    bad["exception"] = details.apply(lambda d: d.get("exception", ""))
-    bad["message"] = details.apply(lambda d: d.get("message", ""))
+    # typed columns; no "message" key is ever logged, the BAD reason goes there instead
+    bad["exception"] = bad["exception"].fillna("")
+    bad["message"] = bad["reason"].fillna("")
 
     total = len(df)
     bad_n = len(bad)
@@ -62,7 +55,7 @@ def main():
 
     md = []
     md.append("# Vigade analüüs\n")
-    md.append(f"- Logifail: `{LOG_PATH}`\n")
+    md.append(f"- Logi: `{log_src}`\n")
     md.append(f"- Katseid kokku: **{total}**\n")
     md.append(f"- Vigaseid (BAD): **{bad_n}**\n\n")
 
@@ -1,30 +1,27 @@
 #!/usr/bin/env python3
-import json
+import sys
 from pathlib import Path
 from warnings import filters
 
+import numpy as np
 import pandas as pd
 from openpyxl import Workbook
 from openpyxl.styles import Font, PatternFill, Alignment
 from openpyxl.worksheet.table import Table, TableStyleInfo
 from openpyxl.utils import get_column_letter
 
-from fill_expected_topk import parse_filters
+BASE = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE))
 
+import query_log  # noqa: E402
+from fill_expected_topk import parse_filters  # noqa: E402
 
-BASE = Path(__file__).resolve().parent.parent
 IN_TESTS = BASE / "out" / "analysis" / "random_testcases_with_expected.csv"
-LOG_PATH = BASE / "out" / "vigade_log.csv"
+QUERY_LOG_DB = BASE / "out" / "query_log.sqlite"
+LOG_PATH = BASE / "out" / "vigade_log.csv"  # old CSV log, used when there is no query_log.sqlite
 OUT_XLSX = BASE / "out" / "analysis" / "testjuhtumid.xlsx"
 
 
-def safe_json_loads(x: str):
-    try:
-        return json.loads(x) if isinstance(x, str) else {}
-    except Exception:
-        return {}
-
-
 def split_codes(s: str):
     if not isinstance(s, str) or not s.strip():
         return []
@@ -82,60 +79,49 @@ def make_xlsx(df: pd.DataFrame, out_path: Path):
     wb.save(out_path)
 
 
-def main():
-    if not IN_TESTS.exists():
-        raise SystemExit(f"Puudub: {IN_TESTS}. Käivita enne generate_random_testcases.py")
-
-    if not LOG_PATH.exists():
-        raise SystemExit(f"Puudub: {LOG_PATH}. Käivita päringud rakenduses, et log tekiks.")
-
-    tests = pd.read_csv(IN_TESTS).fillna("")
-    log = pd.read_csv(LOG_PATH).fillna("")
+def build_report(tests: pd.DataFrame, log: pd.DataFrame) -> pd.DataFrame:
+    """
+    Test cases (with Expected codes) matched against the newest query-log row of each
+    query + filters; PASS/FAIL per case. log: query_log.read_log() / load_log() frame.
+    Raises ValueError if the log lacks columns.
+    """
+    tests = tests.fillna("")
 
-    required_log = {"Aeg", "Päring", "Filtrid", "Tulemus", "DetailidJSON"}
+    required_log = {"Aeg", "Päring", "Filtrid", "Tulemus", "top_codes", "retrieval_only"}
     missing = required_log - set(log.columns)
     if missing:
-        raise SystemExit(f"vigade_log.csv puuduvad veerud: {sorted(missing)}")
-
-    details = log["DetailidJSON"].apply(safe_json_loads)
-    log["top_codes"] = details.apply(lambda d: d.get("top_codes", []))
-    log["top_codes_str"] = log["top_codes"].apply(lambda xs: ", ".join(xs) if isinstance(xs, list) else "")
-
-    # Match newest by (Päring, Filtrid)
-    def parse_filters(filters_str: str):
-        out = {}
-        for part in str(filters_str).split(","):
-            if "=" in part:
-                k, v = part.split("=", 1)
-                out[k.strip()] = v.strip()
-        return out
+        raise ValueError(f"Päringulogist puuduvad veerud: {sorted(missing)}")
 
     #   Match newest by (Päring + core filters). Ignore extra keys present only in tests.
-    CORE_KEYS = {"credits", "semester", "language", "level"}
+    CORE_KEYS = ["credits", "semester", "language", "level"]
+
+    # months of logs: keep only rows of the test queries (one vectorized pass), newest first
+    log = log[list(required_log)].copy()
+    log["_q"] = log["Päring"].astype(str).str.strip()
+    log = log[log["_q"].isin(set(tests["Päring"].astype(str).str.strip()))]
+    log = log.sort_values("Aeg", ascending=False, kind="stable")
+    for k in CORE_KEYS:
+        log[k] = log["Filtrid"].astype(str).str.extract(rf"(?:^|,)\s*{k}\s*=\s*([^,]*)", expand=False).str.strip()
+    # retrieval-only runs (no LLM answer) log the same top_codes, marked retrieval_only
+    log["mode"] = np.where(log["retrieval_only"].astype(bool), "retrieval", "full")
+    log["top_codes_str"] = [", ".join(xs) if isinstance(xs, list) else "" for xs in log["top_codes"]]
+    by_query = {q: g for q, g in log.groupby("_q", sort=False)}
 
     def find_match(query: str, filters: str):
-        tf = parse_filters(filters)
-        # candidates with same query
-        m = log[log["Päring"].astype(str).str.strip() == query.strip()]
-        if len(m) == 0:
-            return None
-
-        # keep only those where core keys match (if present in log)
-        def ok(row):
-            lf = parse_filters(row.get("Filtrid", ""))
-            for k in CORE_KEYS:
-                if k in lf and k in tf and str(lf[k]).strip() != str(tf[k]).strip():
-                    return False
-            return True
-
-        m = m[m.apply(ok, axis=1)]
-        if len(m) == 0:
+        m = by_query.get(query.strip())
+        if m is None:
             return None
-
-        return m.sort_values("Aeg", ascending=False).iloc[0]
+        tf = parse_filters(filters)
+        # core keys must match where both sides have them
+        ok = np.ones(len(m), dtype=bool)
+        for k in CORE_KEYS:
+            if k in tf:
+                ok &= (m[k].isna() | (m[k] == str(tf[k]).strip())).to_numpy()
+        m = m[ok]
+        return None if m.empty else m.iloc[0]
 
     out = tests.copy()
-    log_time, log_result, log_top = [], [], []
+    log_time, log_result, log_top, log_mode = [], [], [], []
     hit_counts, exp_counts, log_counts = [], [], []
 
     for _, r in out.iterrows():
@@ -143,6 +129,7 @@ def main():
         if m is None:
             log_time.append("")
             log_result.append("")
+            log_mode.append("")
             log_top.append("")
             hit_counts.append(0)
             exp_counts.append(len(split_codes(r.get("Expected unique_ID (top_codes)", ""))))
@@ -151,6 +138,7 @@ def main():
 
         log_time.append(m.get("Aeg", ""))
         log_result.append(m.get("Tulemus", ""))
+        log_mode.append(m.get("mode", ""))
         log_top_codes = m.get("top_codes", [])
         log_top.append(m.get("top_codes_str", ""))
 
@@ -162,6 +150,7 @@ def main():
 
     out["Logi aeg"] = log_time
     out["Logi tulemus"] = log_result
+    out["Logi režiim"] = log_mode
     out["Logi top_codes"] = log_top
     out["Expected vs Logi"] = [f"{h}/{e}" for h, e in zip(hit_counts, exp_counts)]
     out["Expected"] = exp_counts
@@ -188,7 +177,7 @@ def main():
     # Notes for failures
     out.loc[out["Logi"] == 0, "Märkus"] = (
         out.loc[out["Logi"] == 0, "Märkus"]
-        .replace("", "Ei leidnud vastavat rida vigade_log.csv-st (päring+filtrid peavad täpselt klappima).")
+        .replace("", "Ei leidnud vastavat rida päringulogist (päring+filtrid peavad täpselt klappima).")
     )
     out.loc[(out["Logi"] > 0) & (out["Expected vs Logi"] == 0), "Märkus"] = (
         out.loc[(out["Logi"] > 0) & (out["Expected vs Logi"] == 0), "Märkus"]
@@ -198,7 +187,22 @@ def main():
     # Reorder columns: ID, Expected vs Logi, Expected, Logi, then the rest
     first_cols = ["ID", "Expected vs Logi", "Expected", "Logi"]
     remaining_cols = [c for c in out.columns if c not in first_cols]
-    out = out[first_cols + remaining_cols]
+    return out[first_cols + remaining_cols]
+
+
+def main():
+    if not IN_TESTS.exists():
+        raise SystemExit(f"Puudub: {IN_TESTS}. Käivita enne generate_random_testcases.py")
+
+    try:
+        log = query_log.load_log(QUERY_LOG_DB, LOG_PATH)
+    except FileNotFoundError:
+        raise SystemExit(f"Puudub: {QUERY_LOG_DB} / {LOG_PATH}. Käivita päringud rakenduses, et log tekiks.")
+
+    try:
+        out = build_report(pd.read_csv(IN_TESTS), log)
+    except ValueError as exc:
+        raise SystemExit(str(exc))
 
     make_xlsx(out, OUT_XLSX)
     print(f"Valmis: {OUT_XLSX}")
@@ -1,16 +1,23 @@
 #!/usr/bin/env python3
 import re
+import sys
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-from sentence_transformers import SentenceTransformer
 
 BASE = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE))
+
+import emb_store  # noqa: E402
+from encoder import backend_from_env, load_encoder  # noqa: E402
+from retrieval import FilterIndex, Retriever, build_meta_to_emb  # noqa: E402
+
 TESTS_PATH = BASE / "out" / "analysis" / "random_testcases.csv"
 DOCS_PATH  = BASE / "out" / "courses_documents.csv"
 META_PATH  = BASE / "out" / "courses_metadata.csv"
 OUT_PATH   = BASE / "out" / "analysis" / "random_testcases_with_expected.csv"
+EMB_DIR    = BASE / "out" / "emb_cache"
 
 # Pane siia SAMA embedding-mudel, mis su äpis
 EMBED_MODEL = "intfloat/multilingual-e5-small"
@@ -35,96 +42,76 @@ def parse_filters(filters_str: str):
             out[k.strip()] = v.strip()
     return out
 
-def norm_credits(x):
-    s = str(x).strip()
-    if s.lower() in ["nan", "none", ""]:
-        return None
-    try:
-        return int(float(s))
-    except Exception:
-        return None
-
-def main():
-    for p in [TESTS_PATH, DOCS_PATH, META_PATH]:
-        if not p.exists():
-            raise SystemExit(f"Puudub fail: {p}")
-
-    tests = pd.read_csv(TESTS_PATH).fillna("")
-    docs  = pd.read_csv(DOCS_PATH).fillna("")
-    meta  = pd.read_csv(META_PATH).fillna("")
+def fill_expected(tests: pd.DataFrame, docs_raw: pd.DataFrame, meta: pd.DataFrame, embedder,
+                  doc_embs: np.ndarray, retriever: Retriever | None = None) -> pd.DataFrame:
+    """
+    tests + "Expected unique_ID (top_codes)": top-k codes by vector search under each test's filters.
+    docs_raw/meta as read by pd.read_csv; doc_embs rows follow docs_raw rows (the out/emb_cache store).
+    Retrieval is Retriever.retrieve_batch (one batched encode, one matmul per filter combination);
+    run_chatbot.py passes its own retriever (same filter index and query cache as the app).
+    Raises ValueError on bad input.
+    """
+    tests = tests.fillna("")
 
     # docs peab sisaldama neid veerge
-    for col in [DOC_KEY_COL, DOC_TEXT_COL, CODE_COL, SEM_COL, LANG_COL, LEVEL_COL]:
-        if col not in docs.columns:
-            raise SystemExit(f"courses_documents.csv puudub veerg: {col}")
-
-    # meta-st on vaja ainult credits (et filtrit 'credits=' kontrollida)
-    if DOC_KEY_COL not in meta.columns or CREDITS_COL not in meta.columns:
-        raise SystemExit("courses_metadata.csv peab sisaldama 'course_uuid' ja 'credits' veerge")
-
-    # merge only credits to avoid suffix hell
-    docs = docs.merge(
-        meta[[DOC_KEY_COL, CREDITS_COL]],
-        on=DOC_KEY_COL,
-        how="left",
-        suffixes=("", "_meta"),
+    for col in [DOC_KEY_COL, DOC_TEXT_COL, CODE_COL]:
+        if col not in docs_raw.columns:
+            raise ValueError(f"courses_documents.csv puudub veerg: {col}")
+
+    if doc_embs.shape[0] != len(docs_raw):
+        raise ValueError(f"doc_embs has {doc_embs.shape[0]} rows, courses_documents.csv {len(docs_raw)}")
+
+    if retriever is None:
+        for col in [DOC_KEY_COL, CREDITS_COL, SEM_COL, LANG_COL, LEVEL_COL]:
+            if col not in meta.columns:
+                raise ValueError(f"courses_metadata.csv puudub veerg: {col}")
+        doc_ids = docs_raw[DOC_KEY_COL].astype(str).tolist()
+        id_to_idx = {cid: i for i, cid in enumerate(doc_ids)}
+        retriever = Retriever(
+            embedder, EMBED_MODEL, doc_embs, doc_ids,
+            FilterIndex(meta, CREDITS_COL, SEM_COL, LANG_COL, LEVEL_COL),
+            build_meta_to_emb(meta[DOC_KEY_COL], id_to_idx),
+            batch_size=BATCH,
+        )
+
+    results = retriever.retrieve_batch(
+        tests["Päring"].astype(str).tolist(), tests["Filtrid"].astype(str).tolist(), TOP_K,
     )
-
-    # precompute embeddings once
-    embedder = SentenceTransformer(EMBED_MODEL)
-    texts = docs[DOC_TEXT_COL].astype(str).tolist()
-    doc_embs = embedder.encode(texts, batch_size=BATCH, normalize_embeddings=True, show_progress_bar=True)
-    doc_embs = np.asarray(doc_embs, dtype=np.float32)
-
-    def filter_mask(f):
-        mask = np.ones(len(docs), dtype=bool)
-
-        if f.get("credits") and f["credits"] != "ANY":
-            c = norm_credits(f["credits"])
-            if c is not None:
-                mask &= docs[CREDITS_COL].apply(norm_credits).to_numpy() == c
-
-        if f.get("semester") and f["semester"] != "ANY":
-            sem = f["semester"].lower()
-            mask &= docs[SEM_COL].astype(str).str.lower().to_numpy() == sem
-
-        if f.get("language") and f["language"] != "ANY":
-            lang = f["language"].lower()
-            mask &= docs[LANG_COL].astype(str).str.lower().to_numpy() == lang
-
-        if f.get("level") and f["level"] != "ANY":
-            lvl = f["level"].lower()
-            mask &= docs[LEVEL_COL].fillna("").astype(str).str.lower().str.contains(lvl, na=False).to_numpy()
-
-        return mask
+    codes = docs_raw[CODE_COL].fillna("").astype(str).to_numpy()
 
     expected_list = []
-    for _, row in tests.iterrows():
-        query = str(row["Päring"])
-        f = parse_filters(row["Filtrid"])
-        idx = np.where(filter_mask(f))[0]
-
-        if len(idx) == 0:
-            expected_list.append("")
-            continue
-
-        q_emb = embedder.encode([query], normalize_embeddings=True)
-        q_emb = np.asarray(q_emb[0], dtype=np.float32)
-
-        scores = doc_embs[idx] @ q_emb
-        top_local = np.argsort(-scores)[:TOP_K]
-        top_global = idx[top_local]
-
-        top_codes = docs.iloc[top_global][CODE_COL].fillna("").astype(str).tolist()
+    for res in results:
         seen = set()
-        top_codes = [c for c in top_codes if c and not (c in seen or seen.add(c))]
-
+        top_codes = [c for c in codes[res["rows"]] if c and not (c in seen or seen.add(c))]
         expected_list.append(", ".join(top_codes[:TOP_K]))
 
     out = tests.copy()
     out["Expected unique_ID (top_codes)"] = expected_list
+    return out
+
+def main():
+    for p in [TESTS_PATH, DOCS_PATH, META_PATH]:
+        if not p.exists():
+            raise SystemExit(f"Puudub fail: {p}")
+
+    tests = pd.read_csv(TESTS_PATH)
+    docs_raw = pd.read_csv(DOCS_PATH)
+    meta = pd.read_csv(META_PATH)
+
+    # doc vectors come from the shared store (out/emb_cache, rows = courses_documents.csv rows);
+    # the corpus is only encoded when courses_documents.csv changed
+    backend = backend_from_env()
+    embedder = load_encoder(EMBED_MODEL, backend)
+    doc_embs, _ = emb_store.open_or_build(
+        EMB_DIR, DOCS_PATH, docs_raw, DOC_KEY_COL, DOC_TEXT_COL, EMBED_MODEL, lambda: embedder,
+        backend=backend,
+    )
+    try:
+        out = fill_expected(tests, docs_raw, meta, embedder, doc_embs)
+    except ValueError as exc:
+        raise SystemExit(str(exc))
     out.to_csv(OUT_PATH, index=False)
     print(f"Valmis: {OUT_PATH}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -196,22 +196,24 @@ def make_query(credits: str, sem: str, lang: str, level: str, title: str | None,
     template = random.choice(PROMPT_TEMPLATES)
     return template.format(n=n, topic_part=topic_part, constraint_part=constraint_part)
 
-def main():
+def run_seed_from_env() -> int:
     seed_str = os.environ.get(SEED_ENV)
 
     # Always keep seed compatible with pandas/numpy random_state: 0 .. 2**32-1
     if seed_str is not None and seed_str.strip():
-        run_seed = int(seed_str) % (2**32 - 1)
-    else:
-        run_seed = int(time.time_ns() % (2**32 - 1))
+        return int(seed_str) % (2**32 - 1)
+    return int(time.time_ns() % (2**32 - 1))
 
+def generate_testcases(meta: pd.DataFrame, run_seed: int, n: int = NUM_TESTCASES) -> pd.DataFrame:
+    """
+    n random test cases from courses_metadata (as read by pd.read_csv, no fillna).
+    Importable: run_chatbot.py passes its already loaded meta_df. Raises ValueError on bad input.
+    """
     random.seed(run_seed)
 
-    meta = pd.read_csv(META_PATH)
-
     for col in [CREDITS_COL, SEM_COL, LANG_COL, LEVEL_COL, CODE_COL]:
         if col not in meta.columns:
-            raise SystemExit(f"Puudub veerg '{col}' failis {META_PATH}")
+            raise ValueError(f"Puudub veerg '{col}' metaandmetes")
 
     title_col = first_existing_col(meta, TITLE_COL_CANDIDATES)
     faculty_col = first_existing_col(meta, FACULTY_COL_CANDIDATES)
@@ -219,10 +221,10 @@ def main():
 
     candidates = meta.dropna(subset=[CREDITS_COL, SEM_COL, LANG_COL, CODE_COL]).copy()
     if len(candidates) == 0:
-        raise SystemExit("Ei leidnud ridu, millel oleks credits+semester+language+code.")
+        raise ValueError("Ei leidnud ridu, millel oleks credits+semester+language+code.")
 
     # sample without replacement to avoid repeated constraints coming from same/similar rows
-    take = min(NUM_TESTCASES * 3, len(candidates))
+    take = min(n * 3, len(candidates))
     sampled_pool = candidates.sample(n=take, replace=False, random_state=run_seed).reset_index(drop=True)
 
     seen = set()
@@ -230,7 +232,7 @@ def main():
     i = 1
     pool_idx = 0
 
-    while i <= NUM_TESTCASES:
+    while i <= n:
         # if pool exhausted, reshuffle a new pool
         if pool_idx >= len(sampled_pool):
             sampled_pool = candidates.sample(n=take, replace=False, random_state=random.randint(0, 2**32 - 1)).reset_index(drop=True)
@@ -308,8 +310,17 @@ def main():
         })
         i += 1
 
+    return pd.DataFrame(rows)
+
+def main():
+    run_seed = run_seed_from_env()
+    try:
+        tests = generate_testcases(pd.read_csv(META_PATH), run_seed)
+    except ValueError as exc:
+        raise SystemExit(f"{exc} ({META_PATH})")
+
     out_csv = OUT_DIR / "random_testcases.csv"
-    pd.DataFrame(rows).to_csv(out_csv, index=False)
+    tests.to_csv(out_csv, index=False)
     print(f"Valmis: {out_csv}")
     print(f"Seed: {run_seed} (set {SEED_ENV} to reproduce)")
 
@@ -1,9 +1,8 @@
 #!/usr/bin/env python3
-import gc
-import json
 import os
 import random
 import re
+import sys
 import time
 from pathlib import Path
 from typing import Optional
@@ -26,6 +25,11 @@ MAX_ATTEMPTS_PER_CASE = 200
 
 # Project paths (matches your repo layout)
 BASE = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE))
+
+import emb_store  # noqa: E402
+from encoder import backend_from_env, load_encoder  # noqa: E402
+
 OUT_DIR = BASE / "out"
 ANALYSIS_DIR = OUT_DIR / "analysis"
 ANALYSIS_DIR.mkdir(parents=True, exist_ok=True)
@@ -36,6 +40,7 @@ DOCS_PATH = OUT_DIR / "courses_documents.csv"
 # Use same cache directory name as run_chatbot.py
 EMB_DIR = OUT_DIR / "emb_cache"
 EMB_DIR.mkdir(parents=True, exist_ok=True)
+EMBED_MODEL = "intfloat/multilingual-e5-small"
 
 # Columns (required-ish)
 CODE_COL = "code"
@@ -161,79 +166,20 @@ def make_prompt(title: str, doc_text: str) -> str:
     return random.choice(PROMPT_TEMPLATES).format(k1=k1, k2=k2, k3=k3)
 
 # -------------------------
-# Embeddings cache (float16 memmap like run_chatbot.py)
+# Embeddings cache (shared emb_store format, same files as run_chatbot.py)
 # -------------------------
-def docs_signature(docs_df: pd.DataFrame, text_col: str, docs_key: str) -> dict:
-    p = DOCS_PATH
-    st = p.stat()
-    return {
-        "path": str(p),
-        "mtime_ns": int(st.st_mtime_ns),
-        "size": int(st.st_size),
-        "model": "intfloat/multilingual-e5-small",
-        "text_col": str(text_col),
-        "key_col": str(docs_key),
-    }
-
 def load_or_build_embeddings(docs_df: pd.DataFrame, text_col: str, docs_key: str):
-    # Local import so running without sentence_transformers gives clear error only when needed
-    from sentence_transformers import SentenceTransformer
-
-    meta_path = EMB_DIR / "emb_meta.json"
-    emb_path = EMB_DIR / "doc_embs_f16.dat"
-    ids_path = EMB_DIR / "doc_ids.json"
-
-    sig = docs_signature(docs_df, text_col, docs_key)
-
     force = os.environ.get(FORCE_REBUILD_ENV, "").strip() == "1"
 
-    def have_valid_cache() -> bool:
-        if force:
-            return False
-        if not (meta_path.exists() and emb_path.exists() and ids_path.exists()):
-            return False
-        try:
-            old = json.loads(meta_path.read_text(encoding="utf-8"))
-        except Exception:
-            return False
-        return old == sig
-
-    embedder = SentenceTransformer("intfloat/multilingual-e5-small")
-
-    if not have_valid_cache():
-        texts = docs_df[text_col].fillna("").astype(str).tolist()
-        ids = docs_df[docs_key].astype(str).tolist()
-
-        # discover dim
-        batch0 = texts[:64] if len(texts) >= 64 else texts
-        e0 = embedder.encode(batch0, normalize_embeddings=True)
-        dim = int(e0.shape[1])
-
-        if emb_path.exists():
-            try:
-                emb_path.unlink()
-            except Exception:
-                pass
-
-        mm = np.memmap(emb_path, mode="w+", dtype=np.float16, shape=(len(texts), dim))
-        mm[: len(e0)] = e0.astype(np.float16)
-
-        bs = 128
-        for start in range(len(e0), len(texts), bs):
-            end = min(start + bs, len(texts))
-            emb = embedder.encode(texts[start:end], normalize_embeddings=True)
-            mm[start:end] = emb.astype(np.float16)
-            gc.collect()
-
-        mm.flush()
-        ids_path.write_text(json.dumps(ids, ensure_ascii=False), encoding="utf-8")
-        meta_path.write_text(json.dumps(sig, ensure_ascii=False), encoding="utf-8")
-
-    ids = json.loads(ids_path.read_text(encoding="utf-8"))
-    n = len(ids)
-    emb_bytes = (EMB_DIR / "doc_embs_f16.dat").stat().st_size
-    dim = int(emb_bytes // (2 * n)) if n > 0 else 0
-    mm = np.memmap(emb_path, mode="r", dtype=np.float16, shape=(n, dim))
+    # queries are encoded here anyway, so the same encoder also serves a stale store
+    backend = backend_from_env()
+    embedder = load_encoder(EMBED_MODEL, backend)
+    mm, ids = emb_store.open_or_build(
+        EMB_DIR, DOCS_PATH, docs_df, docs_key, text_col, EMBED_MODEL,
+        lambda: embedder,
+        force=force,
+        backend=backend,
+    )
     id_to_idx = {cid: i for i, cid in enumerate(ids)}
 
     return embedder, mm, ids, id_to_idx
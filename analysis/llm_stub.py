@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Local OpenAI-compatible stub for latency tests without OpenRouter tokens.
+
+- GET  /v1/models
+- POST /v1/chat/completions (stream=true: SSE chunks + usage, otherwise one JSON answer)
+
+HTTP/1.1 with keep-alive; STUB_DELAY_S simulates model latency before the first token,
+STUB_FAIL_RATE answers that share of chat requests with 429 (retry/backoff tests).
+    python analysis/llm_stub.py            # http://127.0.0.1:8765/v1
+"""
+import json
+import os
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HOST = os.environ.get("STUB_HOST", "127.0.0.1")
+PORT = int(os.environ.get("STUB_PORT", "8765"))
+DELAY_S = float(os.environ.get("STUB_DELAY_S", "0.05"))
+FAIL_RATE = float(os.environ.get("STUB_FAIL_RATE", "0"))
+ANSWER = "Soovitan kursust LTAT.00.001 (stub-vastus)."
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _json(self, code: int, obj: dict):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self._json(200, {"object": "list", "data": [{"id": "stub", "object": "model"}]})
+        else:
+            self._json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers.get("Content-Length", "0"))) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._json(404, {"error": {"message": "not found"}})
+            return
+        if FAIL_RATE > 0 and random.random() < FAIL_RATE:
+            self._json(429, {"error": {"message": "rate limited (stub)", "code": 429}})
+            return
+
+        model = req.get("model", "stub")
+        prompt_tokens = sum(len(str(m.get("content", ""))) // 4 for m in req.get("messages", []))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(ANSWER) // 4,
+                 "total_tokens": prompt_tokens + len(ANSWER) // 4}
+        time.sleep(DELAY_S)
+
+        if not req.get("stream"):
+            self._json(200, {
+                "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": ANSWER}}],
+                "usage": usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        base = {"id": "stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+        for word in ANSWER.split(" "):
+            ev = dict(base, choices=[{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}])
+            self._chunk(f"data: {json.dumps(ev, ensure_ascii=False)}\n\n".encode("utf-8"))
+        ev = dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        self._chunk(f"data: {json.dumps(ev)}\n\n".encode("utf-8"))
+        if (req.get("stream_options") or {}).get("include_usage"):
+            self._chunk(f"data: {json.dumps(dict(base, choices=[], usage=usage))}\n\n".encode("utf-8"))
+        self._chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+def main():
+    server = ThreadingHTTPServer((HOST, PORT), StubHandler)
+    print(f"LLM stub: http://{HOST}:{PORT}/v1 (delay {DELAY_S} s, fail rate {FAIL_RATE})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Startup cost and steady-state RAG latency per embedding residency mode (EMB_RESIDENCY).
+
+Reads OK rows of the live query log (emb_mode, emb_load_s, t_rag_s, t_score_s columns; analysis-job
+rows are left out: concurrent replays and batched retrieval would skew t_rag_s) and writes one row per mode, so memmap / warm / resident can be compared per host.
+"""
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+
+BASE = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE))
+
+import query_log  # noqa: E402
+
+QUERY_LOG_DB = BASE / "out" / "query_log.sqlite"
+LOG_PATH = BASE / "out" / "vigade_log.csv"  # old CSV log, used when there is no query_log.sqlite
+OUT_DIR = BASE / "out" / "analysis"
+OUT_DIR.mkdir(parents=True, exist_ok=True)
+OUT_CSV = OUT_DIR / "residency_report.csv"
+
+
+def main():
+    try:
+        df = query_log.load_log(QUERY_LOG_DB, LOG_PATH, live_only=True)
+    except FileNotFoundError:
+        raise SystemExit(f"Puudub logi: {QUERY_LOG_DB} / {LOG_PATH}")
+    details = df[df["Tulemus"].astype(str).str.upper() == "OK"].dropna(subset=["emb_mode"])
+    if details.empty:
+        raise SystemExit("Logis pole emb_mode välja (käivita päringud uuema run_chatbot.py-ga).")
+
+    for col in ["emb_load_s", "t_rag_s", "t_score_s"]:
+        details[col] = pd.to_numeric(details[col], errors="coerce")
+
+    report = details.groupby("emb_mode").agg(
+        queries=("t_rag_s", "size"),
+        startup_s=("emb_load_s", "median"),
+        t_rag_p50_s=("t_rag_s", "median"),
+        t_rag_p95_s=("t_rag_s", lambda s: s.quantile(0.95)),
+        t_score_p95_s=("t_score_s", lambda s: s.quantile(0.95)),
+    ).reset_index().round(4)
+
+    report.to_csv(OUT_CSV, index=False)
+    print(report.to_string(index=False))
+    print(f"Valmis: {OUT_CSV}")
+
+
+if __name__ == "__main__":
+    main()
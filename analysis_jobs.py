@@ -0,0 +1,138 @@
+"""
+Background jobs for analysis pipeline runs (one daemon thread per job), shared by all sessions.
+
+- every job gets a run id (its query-log rows are tagged with it) and its own directory
+  out/analysis/runs/<run_id>/ (test cases, run log, report), so runs never touch live logs or each other
+- the job reports its stage and done/total/ETA; the UI polls snapshot()
+- cancel() sets an Event; the job stops before its next test case (check_cancelled())
+"""
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable
+
+
+class Cancelled(Exception):
+    pass
+
+
+class AnalysisJob:
+    def __init__(self, run_id: str, run_dir: Path, params: dict[str, Any]):
+        self.run_id = run_id
+        self.run_dir = run_dir
+        self.params = params
+        self.status = "queued"  # running / done / failed / cancelled
+        self.stage = ""
+        self.done = 0
+        self.total = 0
+        self.elapsed_s = 0.0
+        self.eta_s = 0.0
+        self.started = time.time()
+        self.finished: float | None = None
+        self.result: dict[str, Any] = {}
+        self.error = ""
+        self.cancel_event = threading.Event()
+        self._lock = threading.Lock()
+
+    def set_stage(self, stage: str):
+        with self._lock:
+            self.stage = stage
+            self.done = self.total = 0
+            self.elapsed_s = self.eta_s = 0.0
+
+    def progress(self, done: int, total: int, elapsed: float, eta: float):
+        """async_runner.Progress signature, so it can be handed to run_bounded directly."""
+        with self._lock:
+            self.done, self.total, self.elapsed_s, self.eta_s = done, total, elapsed, eta
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise Cancelled(self.run_id)
+
+    def finish(self, status: str, result: dict[str, Any] | None = None, error: str = ""):
+        with self._lock:
+            self.status = status
+            self.result = result or {}
+            self.error = error
+            self.finished = time.time()
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "run_id": self.run_id,
+                "run_dir": str(self.run_dir),
+                "params": dict(self.params),
+                "status": self.status,
+                "stage": self.stage,
+                "done": self.done,
+                "total": self.total,
+                "elapsed_s": self.elapsed_s,
+                "eta_s": self.eta_s,
+                "started": self.started,
+                "finished": self.finished,
+                "result": dict(self.result),
+                "error": self.error,
+                "cancel_requested": self.cancel_event.is_set(),
+            }
+
+
+JobFn = Callable[[AnalysisJob], dict[str, Any]]
+
+
+class JobRegistry:
+    def __init__(self, root: Path, keep: int = 20):
+        self.root = Path(root)
+        self.keep = int(keep)
+        self._jobs: dict[str, AnalysisJob] = {}
+        self._lock = threading.Lock()
+
+    def start(self, fn: JobFn, **params: Any) -> AnalysisJob:
+        """Runs fn(job) in a new daemon thread; fn returns the result dict shown in the UI."""
+        run_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        run_dir = self.root / run_id
+        run_dir.mkdir(parents=True, exist_ok=True)
+        job = AnalysisJob(run_id, run_dir, params)
+        with self._lock:
+            self._jobs[run_id] = job
+            self._prune()
+        threading.Thread(target=self._run, args=(job, fn), name=f"analysis-{run_id}", daemon=True).start()
+        return job
+
+    def _run(self, job: AnalysisJob, fn: JobFn):
+        with job._lock:
+            job.status = "running"
+        try:
+            result = fn(job)
+            job.finish("cancelled" if job.cancelled else "done", result)
+        except Cancelled:
+            job.finish("cancelled")
+        except Exception as exc:
+            job.finish("failed", error=f"{type(exc).__name__}: {exc}")
+
+    def _prune(self):
+        # only finished jobs are forgotten (their run directories stay on disk)
+        finished = [j for j in self._jobs.values() if j.finished is not None]
+        for job in sorted(finished, key=lambda j: j.started)[: max(0, len(self._jobs) - self.keep)]:
+            del self._jobs[job.run_id]
+
+    def get(self, run_id: str) -> AnalysisJob | None:
+        with self._lock:
+            return self._jobs.get(run_id)
+
+    def jobs(self) -> list[AnalysisJob]:
+        """Newest first."""
+        with self._lock:
+            return sorted(self._jobs.values(), key=lambda j: j.started, reverse=True)
+
+    def running(self) -> int:
+        with self._lock:
+            return sum(1 for j in self._jobs.values() if j.finished is None)
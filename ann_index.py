@@ -0,0 +1,133 @@
+"""
+Optional approximate nearest-neighbour index (IVF, CPU-only, numpy) for large catalogues.
+
+Documents are clustered with spherical k-means into `nlist` cells; a query scores the
+centroids, then only the documents in the `nprobe` closest cells. Search is filter-aware:
+only rows in the allowed set are scored, and nprobe is widened when the filter is selective
+so that enough allowed rows are still reached. Small allowed sets use the exact scan.
+
+Files live next to doc_embs_f16.dat: ivf_centroids.npy, ivf_lists.npz, ivf_meta.json.
+"""
+import json
+import math
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from retrieval import FULL_SCAN_MIN_SELECTIVITY, score_rows, scores_for, top_k_positions
+
+CENTROIDS_FILE = "ivf_centroids.npy"
+LISTS_FILE = "ivf_lists.npz"
+META_FILE = "ivf_meta.json"
+IVF_FILES = [CENTROIDS_FILE, LISTS_FILE, META_FILE]
+
+
+def _assign(doc_embs: np.ndarray, centroids: np.ndarray, chunk: int = 16384) -> np.ndarray:
+    out = np.empty(len(doc_embs), dtype=np.int32)
+    for start in range(0, len(doc_embs), chunk):
+        emb = np.asarray(doc_embs[start : start + chunk], dtype=np.float32)
+        out[start : start + len(emb)] = np.argmax(emb @ centroids.T, axis=1)
+    return out
+
+
+def _kmeans(sample: np.ndarray, nlist: int, n_iter: int, rng: np.random.Generator) -> np.ndarray:
+    centroids = sample[rng.choice(len(sample), size=nlist, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=nlist)
+        empty = counts == 0
+        if empty.any():
+            # re-seed empty cells from random sample rows
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.maximum(norms, 1e-12)
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    def __init__(self, centroids: np.ndarray, order: np.ndarray, offsets: np.ndarray):
+        self.centroids = centroids      # (nlist, dim) float32, unit norm
+        self.order = order              # embedding rows sorted by cell
+        self.offsets = offsets          # cell c = order[offsets[c]:offsets[c+1]]
+        self.nlist = int(len(centroids))
+        self.n = int(len(order))
+
+    @classmethod
+    def build(cls, doc_embs: np.ndarray, nlist: int | None = None, n_iter: int = 10,
+              max_train: int = 100_000, seed: int = 0) -> "IVFIndex":
+        n = int(len(doc_embs))
+        if nlist is None:
+            nlist = max(1, int(4 * math.sqrt(n)))
+        nlist = max(1, min(int(nlist), n))
+        rng = np.random.default_rng(seed)
+
+        take = np.sort(rng.choice(n, size=min(n, max(max_train, nlist)), replace=False))
+        sample = np.asarray(doc_embs[take], dtype=np.float32)
+        centroids = _kmeans(sample, nlist, n_iter, rng)
+
+        assign = _assign(doc_embs, centroids)
+        order = np.argsort(assign, kind="stable").astype(np.int64)
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assign, minlength=nlist))
+        return cls(centroids, order, offsets)
+
+    def save(self, out_dir: Path, signature: dict[str, Any]) -> None:
+        np.save(out_dir / CENTROIDS_FILE, self.centroids)
+        np.savez(out_dir / LISTS_FILE, order=self.order, offsets=self.offsets)
+        (out_dir / META_FILE).write_text(json.dumps(signature, ensure_ascii=False), encoding="utf-8")
+
+    @classmethod
+    def load(cls, out_dir: Path, signature: dict[str, Any]) -> "IVFIndex | None":
+        """None if the files are missing or were built for another embedding store."""
+        if not all((out_dir / f).exists() for f in IVF_FILES):
+            return None
+        try:
+            old = json.loads((out_dir / META_FILE).read_text(encoding="utf-8"))
+        except Exception:
+            return None
+        if old != signature:
+            return None
+        lists = np.load(out_dir / LISTS_FILE)
+        return cls(np.load(out_dir / CENTROIDS_FILE), lists["order"], lists["offsets"])
+
+    def candidates(self, q: np.ndarray, allowed: np.ndarray, k: int, nprobe: int) -> np.ndarray:
+        """
+        Allowed rows in the closest cells. nprobe is scaled by 1/selectivity and widened
+        until at least k allowed candidates are found (or all cells are probed).
+        """
+        selectivity = max(float(allowed.sum()) / max(self.n, 1), 1e-6)
+        probe = min(self.nlist, max(1, int(math.ceil(nprobe / selectivity))))
+        cell_order = np.argsort(self.centroids @ q)[::-1]
+
+        while True:
+            cells = cell_order[:probe]
+            rows = np.concatenate([self.order[self.offsets[c] : self.offsets[c + 1]] for c in cells])
+            rows = rows[allowed[rows]]
+            if len(rows) >= k or probe >= self.nlist:
+                return rows
+            probe = min(self.nlist, probe * 2)
+
+
+def ann_search(ivf: IVFIndex | None, doc_embs: np.ndarray, q: np.ndarray, idxs: np.ndarray, k: int,
+               nprobe: int, exact_max: int, full_min: float = FULL_SCAN_MIN_SELECTIVITY
+               ) -> tuple[np.ndarray, np.ndarray, int, str]:
+    """
+    Top-k over allowed embedding rows `idxs`. Returns (rows, scores, docs_scored, path).
+    Falls back to the exact scan ("exact_full" / "exact_gather", see scores_for) when there
+    is no index or the allowed set is small.
+    """
+    if ivf is None or len(idxs) <= exact_max:
+        scores, path, _ = scores_for(doc_embs, idxs, q, full_min)
+        scores = scores[:, 0]
+        top = top_k_positions(scores, k)
+        return idxs[top], scores[top], int(len(idxs)), f"exact_{path}"
+
+    allowed = np.zeros(ivf.n, dtype=bool)
+    allowed[idxs] = True
+    cand = np.sort(ivf.candidates(q, allowed, k, nprobe))
+    scores = score_rows(doc_embs, cand, q)[:, 0]
+    top = top_k_positions(scores, k)
+    return cand[top], scores[top], int(len(cand)), "ivf"
@@ -0,0 +1,111 @@
+"""
+Semantic LLM answer cache (process-wide, run_chatbot.py creates it via st.cache_resource).
+
+Key: (LLM model, active filters string, ordered top-k course ids). Under one key, a stored
+answer is reused when the new query vector has cosine >= min_sim with the query it was
+generated for, so reworded questions that retrieve the same context under the same filters
+do not pay for another LLM call. Entries expire after ttl_s; the total number of entries is
+bounded (least recently used key loses its oldest entry first).
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Iterator
+
+import numpy as np
+
+CacheKey = tuple[str, str, tuple[str, ...]]
+
+
+def answer_key(model: str, filters_str: str, top_ids: list[str]) -> CacheKey:
+    return str(model), str(filters_str).strip(), tuple(str(x) for x in top_ids)
+
+
+def replay(answer: str) -> Iterator[str]:
+    """Stored answer as a stream for st.write_stream (no delay)."""
+    for i, part in enumerate(answer.split(" ")):
+        yield part if i == 0 else " " + part
+
+
+class SemanticAnswerCache:
+    def __init__(self, maxsize: int = 1000, ttl_s: float = 86400.0, min_sim: float = 0.95):
+        self.maxsize = int(maxsize)
+        self.ttl_s = float(ttl_s)
+        self.min_sim = float(min_sim)
+        self._data: OrderedDict[CacheKey, list[dict[str, Any]]] = OrderedDict()
+        self._n = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def _drop_expired(self, key: CacheKey, now: float) -> list[dict[str, Any]]:
+        entries = self._data.get(key, [])
+        alive = [e for e in entries if now - e["created"] <= self.ttl_s]
+        if len(alive) != len(entries):
+            self.expired += len(entries) - len(alive)
+            self._n -= len(entries) - len(alive)
+            if alive:
+                self._data[key] = alive
+            else:
+                self._data.pop(key, None)
+        return alive
+
+    @staticmethod
+    def _best(entries: list[dict[str, Any]], q: np.ndarray) -> tuple[dict[str, Any] | None, float]:
+        best, best_sim = None, -1.0
+        for e in entries:
+            sim = float(np.dot(e["q"], q))
+            if sim > best_sim:
+                best, best_sim = e, sim
+        return best, best_sim
+
+    def get(self, key: CacheKey, q: np.ndarray) -> tuple[dict[str, Any] | None, float | None]:
+        """(entry with "answer"/"usage"/"created", similarity) or (None, best similarity / None if no entry)."""
+        q = np.asarray(q, dtype=np.float32)
+        with self._lock:
+            entries = self._drop_expired(key, time.time())
+            best, sim = self._best(entries, q)
+            if best is None or sim < self.min_sim:
+                self.misses += 1
+                return None, (sim if best is not None else None)
+            self._data.move_to_end(key)
+            self.hits += 1
+            return best, sim
+
+    def put(self, key: CacheKey, q: np.ndarray, answer: str, usage: dict[str, Any] | None = None) -> None:
+        if not answer:
+            return
+        q = np.array(q, dtype=np.float32)
+        q.setflags(write=False)
+        entry = {"q": q, "answer": answer, "usage": dict(usage or {}), "created": time.time()}
+        with self._lock:
+            entries = self._drop_expired(key, entry["created"])
+            best, sim = self._best(entries, q)
+            if best is not None and sim >= self.min_sim:
+                entries.remove(best)  # refresh instead of keeping near-duplicates
+                self._n -= 1
+            entries.append(entry)
+            self._n += 1
+            self._data[key] = entries
+            self._data.move_to_end(key)
+            while self._n > self.maxsize:
+                old_key, old_entries = next(iter(self._data.items()))
+                old_entries.pop(0)
+                self._n -= 1
+                self.evicted += 1
+                if not old_entries:
+                    del self._data[old_key]
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": self._n,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Bounded-concurrency, rate-limited runner for many independent LLM requests (analysis test cases).
+
+- run_bounded(): at most `concurrency` items in flight, results in input order,
+  progress(done, total, elapsed_s, eta_s) after every item
+- TokenBucket: `rate` requests/s with bursts up to `burst` (OpenRouter request limits)
+- with_retries(): exponential backoff with jitter on 429 / 5xx / connection errors
+
+Against the local stub (failure injection exercises the retries):
+    STUB_FAIL_RATE=0.2 python analysis/llm_stub.py &
+    LLM_BASE_URL=http://127.0.0.1:8765/v1 python async_runner.py
+"""
+import asyncio
+import os
+import random
+import time
+from typing import Any, Awaitable, Callable, Sequence, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+Progress = Callable[[int, int, float, float], None]
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(burst))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> float:
+        """Takes one token, sleeping until one is available. Returns seconds waited."""
+        if self.rate <= 0:
+            return 0.0
+        waited = 0.0
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return waited
+                delay = (1.0 - self._tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+
+
+def is_retryable(exc: BaseException) -> bool:
+    status = getattr(exc, "status_code", None)
+    if status is not None:
+        return int(status) in RETRY_STATUS
+    name = type(exc).__name__
+    return name in {"APIConnectionError", "APITimeoutError"} or isinstance(exc, (TimeoutError, ConnectionError))
+
+
+async def with_retries(fn: Callable[[], Awaitable[R]], retries: int = 3, base_delay: float = 1.0,
+                       max_delay: float = 30.0, limiter: TokenBucket | None = None,
+                       retry_on: Callable[[BaseException], bool] = is_retryable) -> tuple[R, int]:
+    """Runs fn() (after limiter.acquire()), retrying retryable errors. Returns (result, retries used)."""
+    attempt = 0
+    while True:
+        if limiter is not None:
+            await limiter.acquire()
+        try:
+            return await fn(), attempt
+        except Exception as exc:
+            if attempt >= retries or not retry_on(exc):
+                raise
+            delay = min(max_delay, base_delay * (2 ** attempt)) * (0.5 + random.random() / 2)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def run_bounded(items: Sequence[T], worker: Callable[[T], Awaitable[R]], concurrency: int,
+                      progress: Progress | None = None) -> list[R]:
+    """worker(item) for every item, at most `concurrency` at a time; results in input order."""
+    sem = asyncio.Semaphore(max(1, int(concurrency)))
+    total = len(items)
+    done = 0
+    t0 = time.perf_counter()
+
+    async def one(item: T) -> R:
+        nonlocal done
+        async with sem:
+            out = await worker(item)
+        done += 1
+        if progress is not None:
+            elapsed = time.perf_counter() - t0
+            eta = elapsed / done * (total - done)
+            progress(done, total, elapsed, eta)
+        return out
+
+    return list(await asyncio.gather(*(one(x) for x in items)))
+
+
+def main():
+    from llm_client import make_async_client
+
+    base_url = os.environ.get("LLM_BASE_URL", "http://127.0.0.1:8765/v1")
+    model = os.environ.get("LLM_MODEL", "google/gemma-3-27b-it")
+    n = int(os.environ.get("RUNNER_N", "40"))
+    concurrency = int(os.environ.get("ANALYSIS_CONCURRENCY", "8"))
+    rate = float(os.environ.get("ANALYSIS_RATE_PER_S", "20"))
+
+    async def run() -> list[dict[str, Any]]:
+        aclient = make_async_client(base_url, os.environ.get("OPENROUTER_API_KEY", "stub"),
+                                    pool_size=concurrency, max_retries=0)
+        limiter = TokenBucket(rate, burst=concurrency)
+
+        async def worker(i: int) -> dict[str, Any]:
+            try:
+                resp, retries = await with_retries(
+                    lambda: aclient.chat.completions.create(
+                        model=model, messages=[{"role": "user", "content": f"päring {i}"}],
+                    ),
+                    retries=4, base_delay=0.2, limiter=limiter,
+                )
+                return {"ok": bool(resp.choices[0].message.content), "retries": retries}
+            except Exception as exc:
+                return {"ok": False, "retries": -1, "error": type(exc).__name__}
+
+        def progress(done: int, total: int, elapsed: float, eta: float):
+            if done == total or done % max(1, total // 10) == 0:
+                print(f"  {done}/{total}, {elapsed:.1f} s, ETA {eta:.1f} s", flush=True)
+
+        try:
+            return await run_bounded(list(range(n)), worker, concurrency, progress)
+        finally:
+            await aclient.close()
+
+    t = time.perf_counter()
+    results = asyncio.run(run())
+    dt = time.perf_counter() - t
+    ok = sum(r["ok"] for r in results)
+    retried = sum(max(r["retries"], 0) for r in results)
+    print(f"LLM: {base_url}, requests: {n}, concurrency: {concurrency}, rate: {rate}/s")
+    print(f"OK {ok}/{n}, retries {retried}, failed {n - ok} in {dt:.2f} s ({n / dt:.1f} req/s)")
+
+
+if __name__ == "__main__":
+    main()
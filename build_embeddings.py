@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Standalone embedding build for out/emb_cache (the app only opens a finished store).
+
+- EMB_WORKERS encoder processes (default: half of the cores), each pinned to its own cores
+- checkpoints + resume marker via emb_store (re-run after a crash continues where it stopped)
+- incremental: only new/changed documents are encoded; the hash diff runs first, so tokenizing,
+  the worker pool (at most one worker per batch) and model loads only happen for those documents
+- length-bucketed batches: documents sorted by token count, each batch sized by EMB_TOKEN_BUDGET
+  padded tokens (not a fixed row count), vectors scattered back to their corpus rows
+- per-section token counts for token-budgeted RAG context (doc_tokens.json, see context_budget.py);
+  CONTEXT_TOKENIZER picks the tokenizer (default: the encoder's)
+- progress in docs/s
+- EMB_BACKEND selects the encoder inference backend (torch / torch-int8 / onnx / onnx-int8, see encoder.py);
+  it is recorded in emb_meta.json and a store built with another backend is re-encoded in full
+
+    python build_embeddings.py
+    EMB_WORKERS=4 REBUILD_EMB=1 python build_embeddings.py   # full re-encode
+"""
+import multiprocessing as mp
+import os
+import time
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import numpy as np
+import pandas as pd
+
+import emb_store
+from context_budget import load_token_counts, save_token_counts, section_token_counts
+import encoder
+
+BASE = Path(__file__).parent
+OUT_DIR = BASE / "out"
+DOCS_PATH = OUT_DIR / "courses_documents.csv"
+EMB_DIR = OUT_DIR / "emb_cache"
+
+EMBED_MODEL = "intfloat/multilingual-e5-small"
+BATCH = 128          # max rows per batch
+MAX_TOKENS = 512     # encoder truncation (multilingual-e5-small max_seq_length)
+
+WORKERS_ENV = "EMB_WORKERS"
+FORCE_REBUILD_ENV = "REBUILD_EMB"
+TOKEN_BUDGET_ENV = "EMB_TOKEN_BUDGET"
+CONTEXT_TOKENIZER = os.environ.get("CONTEXT_TOKENIZER", "").strip() or EMBED_MODEL
+
+DOCS_KEY_CANDIDATES = ["course_uuid", "uuid", "id"]
+TEXT_COL_CANDIDATES = ["document_text", "text", "content"]
+
+
+def first_existing_col(df: pd.DataFrame, candidates: list[str]) -> str | None:
+    for c in candidates:
+        if c in df.columns:
+            return c
+    return None
+
+
+def load_tokenizer(model_name: str):
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(model_name)
+
+
+def token_lengths(texts: list[str], model_name: str = EMBED_MODEL, chunk: int = 4096) -> np.ndarray:
+    """Tokens per text as the encoder sees them (special tokens included, truncated at MAX_TOKENS)."""
+    tok = load_tokenizer(model_name)
+    out = np.empty(len(texts), dtype=np.int32)
+    for start in range(0, len(texts), chunk):
+        enc = tok(texts[start : start + chunk], truncation=True, max_length=MAX_TOKENS)
+        out[start : start + chunk] = [len(ids) for ids in enc["input_ids"]]
+    return out
+
+
+def write_context_tokens(texts: list[str]) -> None:
+    """doc_tokens.json for the current store (skipped if it already matches)."""
+    store_meta = emb_store.read_meta(EMB_DIR)
+    if store_meta is None or load_token_counts(EMB_DIR, store_meta) is not None:
+        return
+    t = time.perf_counter()
+    counts = section_token_counts(texts, load_tokenizer(CONTEXT_TOKENIZER))
+    save_token_counts(EMB_DIR, counts, store_meta, CONTEXT_TOKENIZER)
+    print(f"Kontekstitokenid ({CONTEXT_TOKENIZER}): {len(counts)} docs in {time.perf_counter() - t:.1f} s")
+
+
+# -------------------------
+# Worker processes
+# -------------------------
+_embedder = None
+
+
+def _init_worker(model_name: str, backend: str, core_sets: list[list[int]], counter, lock):
+    global _embedder
+    with lock:
+        slot = counter.value
+        counter.value += 1
+    cores = core_sets[slot % len(core_sets)]
+    if hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cores)
+        except OSError:
+            pass
+
+    import torch
+
+    torch.set_num_threads(len(cores))
+    _embedder = encoder.load_encoder(model_name, backend)
+
+
+def _encode_job(job: tuple[int, list[str]]) -> tuple[int, np.ndarray]:
+    batch_no, texts = job
+    emb = _embedder.encode(texts, batch_size=len(texts), normalize_embeddings=True)
+    return batch_no, np.asarray(emb, dtype=np.float16)
+
+
+def _core_sets(workers: int) -> list[list[int]]:
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    per = max(1, len(cores) // workers)
+    return [cores[i * per : (i + 1) * per] or cores for i in range(workers)]
+
+
+def pool_encode_map(pool) -> emb_store.EncodeMap:
+    def run(jobs: Iterable[tuple[int, list[str]]]) -> Iterator[tuple[int, np.ndarray]]:
+        yield from pool.imap_unordered(_encode_job, jobs)
+    return run
+
+
+def main():
+    if not DOCS_PATH.exists():
+        raise SystemExit(f"Puudub: {DOCS_PATH}")
+
+    docs = pd.read_csv(DOCS_PATH)
+    docs_key = first_existing_col(docs, DOCS_KEY_CANDIDATES)
+    text_col = first_existing_col(docs, TEXT_COL_CANDIDATES)
+    if docs_key is None or text_col is None:
+        raise SystemExit(f"courses_documents.csv vajab veerge {DOCS_KEY_CANDIDATES} ja {TEXT_COL_CANDIDATES}")
+
+    backend = encoder.backend_from_env()
+    sig = emb_store.docs_signature(DOCS_PATH, EMBED_MODEL, text_col, docs_key, backend)
+    force = os.environ.get(FORCE_REBUILD_ENV, "").strip() == "1"
+    texts = docs[text_col].fillna("").astype(str).tolist()
+    if not force and emb_store.is_current(EMB_DIR, sig):
+        print(f"Embeddingud on ajakohased: {EMB_DIR}")
+        write_context_tokens(texts)
+        return
+    old_meta = emb_store.read_meta(EMB_DIR)
+    if old_meta and emb_store.store_backend(old_meta) != backend:
+        print(f"Store on ehitatud backendiga {emb_store.store_backend(old_meta)}, nüüd {backend}: "
+              "kõik dokumendid kodeeritakse uuesti")
+
+    # hash diff first: tokenizer, workers and model loads are only paid for documents that change
+    todo = emb_store.rows_to_encode(EMB_DIR, docs, docs_key, text_col, sig, reuse=not force)
+    token_budget = int(os.environ.get(TOKEN_BUDGET_ENV, "") or emb_store.TOKEN_BUDGET)
+    lengths = np.zeros(len(texts), dtype=np.int32)
+    if todo:
+        lengths[todo] = token_lengths([texts[i] for i in todo])
+    n_batches = len(emb_store.plan_batches(todo, lengths, BATCH, token_budget))
+    workers = int(os.environ.get(WORKERS_ENV, "") or max(1, (os.cpu_count() or 2) // 2))
+    workers = max(1, min(workers, n_batches))
+    print(f"Docs: {len(docs)}, to encode: {len(todo)} in {n_batches} batches, backend: {backend}, "
+          f"workers: {workers if todo else 0}, token budget: {token_budget}, max batch: {BATCH}")
+    if todo:
+        print(f"  tokens/doc: median {int(np.median(lengths[todo]))}, max {int(lengths[todo].max())}")
+
+    last_print = [0.0]
+
+    def progress(encoded: int, total: int, docs_per_s: float):
+        now = time.perf_counter()
+        if now - last_print[0] >= 2.0 or encoded == total:
+            last_print[0] = now
+            eta = (total - encoded) / docs_per_s if docs_per_s > 0 else float("nan")
+            print(f"  {encoded}/{total} docs, {docs_per_s:.1f} docs/s, ETA {eta:.0f} s", flush=True)
+
+    t0 = time.perf_counter()
+    build = dict(batch_size=BATCH, reuse=not force, progress=progress, lengths=lengths, token_budget=token_budget)
+    if not todo:
+        # only ids / order / mtime changed: no pool; the encoder is only loaded if there is no old store
+        stats = emb_store.update_store(
+            EMB_DIR, docs, docs_key, text_col, sig,
+            encode=lambda batch: encoder.load_encoder(EMBED_MODEL, backend).encode(batch, normalize_embeddings=True),
+            **build,
+        )
+    else:
+        encoder.prepare(EMBED_MODEL, backend)
+        ctx = mp.get_context("spawn")
+        counter, lock = ctx.Value("i", 0), ctx.Lock()
+        with ctx.Pool(workers, initializer=_init_worker,
+                      initargs=(EMBED_MODEL, backend, _core_sets(workers), counter, lock)) as pool:
+            stats = emb_store.update_store(
+                EMB_DIR, docs, docs_key, text_col, sig,
+                encode_map=pool_encode_map(pool),
+                **build,
+            )
+    dt = time.perf_counter() - t0
+    write_context_tokens(texts)
+
+    print(f"Valmis: {EMB_DIR / emb_store.EMB_FILE}")
+    print(f"  reused {stats['reused']}, encoded {stats['encoded']}, dropped {stats['dropped']} "
+          f"in {dt:.1f} s ({stats['encoded'] / max(dt, 1e-9):.1f} docs/s)")
+
+
+if __name__ == "__main__":
+    main()
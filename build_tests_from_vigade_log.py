@@ -2,7 +2,10 @@
 import os, json
 import pandas as pd
 
-IN_LOG = "out/vigade_log.csv"                 # change if needed
+import query_log
+
+IN_DB = "out/query_log.sqlite"
+IN_LOG = "out/vigade_log.csv"                 # old CSV log, used when there is no query_log.sqlite
 OUT_DIR = "out/analysis"
 OUT_IN  = os.path.join(OUT_DIR, "in_tests.csv")
 OUT_EXP = os.path.join(OUT_DIR, "expected_snapshot.csv")
@@ -11,27 +14,10 @@ OUT_EXP = os.path.join(OUT_DIR, "expected_snapshot.csv")
 BASELINE_MODE = "first"
 
 def main():
-    df = pd.read_csv(IN_LOG)
-
-    # keep only final step successes
-    if "Samm" in df.columns:
-        df = df[df["Samm"].astype(str).str.strip().eq("llm_generate")]
-    if "Tulemus" in df.columns:
-        df = df[df["Tulemus"].astype(str).str.strip().eq("OK")]
-
-    # parse DetailidJSON safely
-    def parse_detail(s):
-        try:
-            return json.loads(s) if isinstance(s, str) and s.strip() else {}
-        except Exception:
-            return {}
-
-    details = df["DetailidJSON"].apply(parse_detail) if "DetailidJSON" in df.columns else [{}]*len(df)
-    df = df.copy()
-    df["top_codes"] = details.apply(lambda d: d.get("top_codes", []))
-    df["top_k"] = details.apply(lambda d: d.get("top_k", None))
-    df["filtered_count"] = details.apply(lambda d: d.get("filtered_count", None))
-    df["docs_scored"] = details.apply(lambda d: d.get("docs_scored", None))
+    # final step successes of live traffic; top_codes / top_k / filtered_count / docs_scored are columns
+    df = query_log.load_log(IN_DB, IN_LOG, step="llm_generate", status="OK", live_only=True)
+    df = df[df["Samm"].astype(str).str.strip().eq("llm_generate")]
+    df = df[df["Tulemus"].astype(str).str.strip().eq("OK")].copy()
 
     # normalize key fields
     df["Päring"] = df["Päring"].astype(str).str.strip()
@@ -0,0 +1,118 @@
+"""
+Token-budgeted RAG context assembly for the system prompt.
+
+document_text is built by cleaner_configurable.py as one "Label: content" line per section,
+in priority order (title, description, objectives, learning outcomes, prerequisites).
+build_embeddings.py counts tokens per section once per store build (doc_tokens.json next to
+the embeddings); at query time documents are added in rank order, section by section:
+- each document gets at most `doc_max` tokens, its last fitting section cut at a word boundary
+- the context stops growing once `budget` tokens are reached
+Without a token file (or for rows it does not cover) counts fall back to ~4 chars/token.
+"""
+import json
+from pathlib import Path
+from typing import Any, Sequence
+
+SECTION_SEP = "\n"
+TOKENS_FILE = "doc_tokens.json"
+CONTEXT_TOKEN_BUDGET = 3000
+CONTEXT_DOC_MAX_TOKENS = 800
+CHARS_PER_TOKEN = 4
+
+
+def split_sections(text: str) -> list[str]:
+    return [s for s in str(text or "").split(SECTION_SEP) if s.strip()]
+
+
+def approx_section_tokens(sections: Sequence[str]) -> list[int]:
+    return [max(1, len(s) // CHARS_PER_TOKEN) for s in sections]
+
+
+def section_token_counts(texts: Sequence[str], tokenizer: Any, chunk: int = 4096) -> list[list[int]]:
+    """Real tokenizer counts per section of every text (no special tokens, no truncation)."""
+    sections = [split_sections(t) for t in texts]
+    flat = [s for secs in sections for s in secs]
+    counts: list[int] = []
+    for start in range(0, len(flat), chunk):
+        enc = tokenizer(flat[start : start + chunk], add_special_tokens=False)
+        counts.extend(len(ids) for ids in enc["input_ids"])
+    out, pos = [], 0
+    for secs in sections:
+        out.append(counts[pos : pos + len(secs)])
+        pos += len(secs)
+    return out
+
+
+def save_token_counts(out_dir: Path, counts: list[list[int]], signature: dict[str, Any], tokenizer: str) -> None:
+    payload = {"signature": signature, "tokenizer": tokenizer, "sections": counts}
+    (out_dir / TOKENS_FILE).write_text(json.dumps(payload, ensure_ascii=False), encoding="utf-8")
+
+
+def load_token_counts(out_dir: Path, signature: dict[str, Any]) -> list[list[int]] | None:
+    """None if the file is missing or was built for another embedding store (signature = emb_meta.json)."""
+    try:
+        payload = json.loads((out_dir / TOKENS_FILE).read_text(encoding="utf-8"))
+    except Exception:
+        return None
+    if payload.get("signature") != signature:
+        return None
+    return payload.get("sections")
+
+
+def _cut(section: str, tokens: int, keep: int) -> str:
+    """First ~keep of `tokens` tokens of a section, at a word boundary."""
+    if keep <= 0:
+        return ""
+    n_chars = int(len(section) * keep / max(tokens, 1))
+    cut = section[:n_chars]
+    if n_chars < len(section) and " " in cut:
+        cut = cut[: cut.rfind(" ")]
+    return cut.rstrip() + " …" if cut.strip() else ""
+
+
+def assemble_context(docs: Sequence[tuple[str, str, list[int] | None]], budget: int = CONTEXT_TOKEN_BUDGET,
+                     doc_max: int = CONTEXT_DOC_MAX_TOKENS) -> tuple[str, dict[str, Any]]:
+    """
+    docs: (header, document_text, section token counts or None) in rank order.
+    Returns (context text, {"context_tokens", "context_docs", "context_docs_truncated"}).
+    """
+    blocks: list[str] = []
+    used = 0
+    truncated = 0
+    for header, text, sec_tokens in docs:
+        remaining = budget - used
+        if remaining <= 0:
+            break
+        sections = split_sections(text)
+        if sec_tokens is None or len(sec_tokens) != len(sections):
+            sec_tokens = approx_section_tokens(sections)
+
+        header_tokens = max(1, len(header) // CHARS_PER_TOKEN) if header else 0
+        allowed = min(doc_max, remaining) - header_tokens
+        if allowed <= 0:
+            break
+
+        kept: list[str] = []
+        doc_tokens = 0
+        cut = False
+        for sec, n in zip(sections, sec_tokens):
+            if doc_tokens + n <= allowed:
+                kept.append(sec)
+                doc_tokens += n
+                continue
+            part = _cut(sec, n, allowed - doc_tokens)
+            if part:
+                kept.append(part)
+                doc_tokens = allowed
+            cut = True
+            break
+
+        blocks.append(SECTION_SEP.join([f"- {header}"] + kept).strip())
+        used += header_tokens + doc_tokens
+        truncated += int(cut)
+
+    return "\n\n".join(blocks), {
+        "context_tokens": int(used),
+        "context_docs": len(blocks),
+        "context_docs_truncated": truncated,
+    }
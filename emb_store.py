@@ -0,0 +1,336 @@
+"""
+On-disk document embedding store (out/emb_cache), shared by run_chatbot.py and the analysis scripts.
+
+Files:
+- doc_embs_f16.dat  float16 matrix in .npy format (header carries dtype + shape, opened as memmap)
+- doc_ids.json      course id per row
+- doc_hashes.json   content hash of (course id, text) per row
+- emb_meta.json     model, encoder backend, columns, source file signature, n/dim/dtype
+
+Rebuilds are incremental: rows whose (id, text) hash already exists in the old store are copied,
+only new or changed documents are encoded, and rows no longer in the corpus are dropped.
+Vectors are only reused from a store built with the same encoder backend (a backend change re-encodes all).
+Documents to encode can be bucketed by token length (plan_batches) so a batch is padded to
+similar lengths and sized by a token budget instead of a fixed row count.
+Builds checkpoint into doc_embs_f16.dat.tmp + build_progress.json and resume after a crash;
+readers only ever see a completed store (emb_meta.json is written last).
+Big rebuilds: python build_embeddings.py (parallel workers, progress in docs/s); scripts use open_or_build().
+"""
+import gc
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any, Callable, Iterable, Iterator, Sequence
+
+import numpy as np
+import pandas as pd
+
+EMB_FILE = "doc_embs_f16.dat"
+IDS_FILE = "doc_ids.json"
+HASHES_FILE = "doc_hashes.json"
+META_FILE = "emb_meta.json"
+PROGRESS_FILE = "build_progress.json"
+STORE_FILES = [EMB_FILE, IDS_FILE, HASHES_FILE, META_FILE]
+CHECKPOINT_S = 30.0
+TOKEN_BUDGET = 16384  # padded tokens per batch (rows * longest row)
+
+# (batch_no, texts) jobs -> (batch_no, vectors) results, in any order
+EncodeMap = Callable[[Iterable[tuple[int, list[str]]]], Iterator[tuple[int, np.ndarray]]]
+
+FORMAT_VERSION = 2
+DTYPE = np.float16
+NPY_MAGIC = b"\x93NUMPY"
+LEGACY_BACKEND = "torch"  # stores written before emb_meta.json recorded the backend
+
+
+def doc_hash(doc_id: str, text: str) -> str:
+    return hashlib.blake2b(f"{doc_id}\x1f{text}".encode("utf-8"), digest_size=16).hexdigest()
+
+
+def docs_signature(docs_path: Path, model: str, text_col: str, key_col: str,
+                   backend: str = LEGACY_BACKEND) -> dict[str, Any]:
+    stt = docs_path.stat()
+    return {
+        "path": str(docs_path),
+        "mtime_ns": int(stt.st_mtime_ns),
+        "size": int(stt.st_size),
+        "model": model,
+        "backend": backend,
+        "text_col": str(text_col),
+        "key_col": str(key_col),
+    }
+
+
+def _read_json(path: Path) -> Any:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except Exception:
+        return None
+
+
+def _is_npy(path: Path) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(NPY_MAGIC)) == NPY_MAGIC
+    except OSError:
+        return False
+
+
+def read_meta(emb_dir: Path) -> dict[str, Any] | None:
+    meta = _read_json(emb_dir / META_FILE)
+    return meta if isinstance(meta, dict) else None
+
+
+def store_backend(meta: dict[str, Any]) -> str:
+    return str(meta.get("backend", LEGACY_BACKEND))
+
+
+def _meta_value(meta: dict[str, Any], key: str) -> Any:
+    return store_backend(meta) if key == "backend" else meta.get(key)
+
+
+def is_current(emb_dir: Path, sig: dict[str, Any]) -> bool:
+    """Store exists in the current format and was built from exactly this docs file/model/columns."""
+    meta = read_meta(emb_dir)
+    if not meta or meta.get("format") != FORMAT_VERSION:
+        return False
+    if not all((emb_dir / f).exists() for f in STORE_FILES) or not _is_npy(emb_dir / EMB_FILE):
+        return False
+    return all(_meta_value(meta, k) == v for k, v in sig.items())
+
+
+def open_store(emb_dir: Path) -> tuple[np.memmap, list[str]]:
+    """Read-only memmap (shape/dtype from the file header) + row ids."""
+    mm = np.load(emb_dir / EMB_FILE, mmap_mode="r")
+    ids = json.loads((emb_dir / IDS_FILE).read_text(encoding="utf-8"))
+    if mm.shape[0] != len(ids):
+        raise ValueError(f"{EMB_FILE} has {mm.shape[0]} rows but {IDS_FILE} has {len(ids)} ids")
+    return mm, ids
+
+
+def _old_vectors(emb_dir: Path, sig: dict[str, Any]) -> tuple[np.memmap | None, dict[str, int]]:
+    """Previous store + hash -> row, if it can be reused (same format, model, backend and text column)."""
+    meta = read_meta(emb_dir)
+    if not meta or meta.get("format") != FORMAT_VERSION:
+        return None, {}
+    if any(_meta_value(meta, k) != sig.get(k) for k in ("model", "backend", "text_col")):
+        return None, {}
+    hashes = _read_json(emb_dir / HASHES_FILE)
+    if not isinstance(hashes, list) or not _is_npy(emb_dir / EMB_FILE):
+        return None, {}
+    try:
+        old = np.load(emb_dir / EMB_FILE, mmap_mode="r")
+    except Exception:
+        return None, {}
+    if old.shape[0] != len(hashes):
+        return None, {}
+    row_of: dict[str, int] = {}
+    for i, h in enumerate(hashes):
+        row_of.setdefault(h, i)
+    return old, row_of
+
+
+def _diff(hashes: list[str], old_row_of: dict[str, int]) -> tuple[list[int], list[int], list[int]]:
+    """(new rows reused, their old rows, new rows to encode)."""
+    reuse_new, reuse_old, todo = [], [], []
+    for i, h in enumerate(hashes):
+        j = old_row_of.get(h)
+        if j is None:
+            todo.append(i)
+        else:
+            reuse_new.append(i)
+            reuse_old.append(j)
+    return reuse_new, reuse_old, todo
+
+
+def rows_to_encode(emb_dir: Path, docs_df: pd.DataFrame, key_col: str, text_col: str,
+                   sig: dict[str, Any], reuse: bool = True) -> list[int]:
+    """
+    Corpus rows update_store() would encode (same hash diff, nothing is loaded but the hashes),
+    so a caller can size its encoder pool / tokenize only those rows before the build.
+    """
+    texts = docs_df[text_col].fillna("").astype(str).tolist()
+    ids = docs_df[key_col].astype(str).tolist()
+    hashes = [doc_hash(i, t) for i, t in zip(ids, texts)]
+    row_of: dict[str, int] = {}
+    if reuse:
+        old, row_of = _old_vectors(emb_dir, sig)
+        del old
+    return _diff(hashes, row_of)[2]
+
+
+def read_progress(emb_dir: Path) -> dict[str, Any] | None:
+    """Resume marker of an unfinished build (None if no build is in progress / it finished)."""
+    prog = _read_json(emb_dir / PROGRESS_FILE)
+    return prog if isinstance(prog, dict) else None
+
+
+def _write_progress(emb_dir: Path, prog: dict[str, Any]) -> None:
+    tmp = emb_dir / (PROGRESS_FILE + ".tmp")
+    tmp.write_text(json.dumps(prog), encoding="utf-8")
+    os.replace(tmp, emb_dir / PROGRESS_FILE)
+
+
+def _sequential_map(encode: Callable[[list[str]], np.ndarray]) -> EncodeMap:
+    def run(jobs: Iterable[tuple[int, list[str]]]) -> Iterator[tuple[int, np.ndarray]]:
+        for batch_no, texts in jobs:
+            yield batch_no, np.asarray(encode(texts))
+            # be nice to memory
+            gc.collect()
+    return run
+
+
+def plan_batches(rows: list[int], lengths: Sequence[int] | None, batch_size: int,
+                 token_budget: int | None = None) -> list[list[int]]:
+    """
+    Splits rows into encode batches. Without lengths: fixed slices of batch_size in corpus order.
+    With lengths (tokens per row): rows sorted longest first, each batch filled while
+    rows * longest <= token_budget (at most batch_size rows), so short texts are not padded
+    to the length of a long one.
+    """
+    if lengths is None:
+        return [rows[s : s + batch_size] for s in range(0, len(rows), batch_size)]
+    budget = token_budget or TOKEN_BUDGET
+    ordered = sorted(rows, key=lambda i: (-int(lengths[i]), i))
+    batches, cur, longest = [], [], 0
+    for i in ordered:
+        ln = max(int(lengths[i]), 1)
+        if cur and (len(cur) >= batch_size or (len(cur) + 1) * longest > budget):
+            batches.append(cur)
+            cur = []
+        if not cur:
+            longest = ln
+        cur.append(i)
+    if cur:
+        batches.append(cur)
+    return batches
+
+
+def update_store(emb_dir: Path, docs_df: pd.DataFrame, key_col: str, text_col: str,
+                 sig: dict[str, Any], encode: Callable[[list[str]], np.ndarray] | None = None,
+                 batch_size: int = 128, reuse: bool = True, encode_map: EncodeMap | None = None,
+                 progress: Callable[[int, int, float], None] | None = None,
+                 checkpoint_s: float = CHECKPOINT_S, lengths: Sequence[int] | None = None,
+                 token_budget: int | None = None) -> dict[str, int]:
+    """
+    (Re)builds the store for docs_df, reusing vectors of unchanged (id, text) rows
+    (reuse=False re-encodes everything).
+
+    Documents to encode are split into numbered batches (plan_batches: length buckets under
+    token_budget when per-row token `lengths` are given; only entries of rows to encode are read,
+    see rows_to_encode()); vectors are scattered back to
+    their corpus rows. encode_map takes (batch_no, texts) jobs
+    and yields (batch_no, vectors) in any order (e.g. from a process pool); default is `encode`
+    in-process. Every checkpoint_s seconds the temp matrix is flushed and build_progress.json
+    records the finished batches, so an interrupted build resumes where it stopped.
+    progress(encoded, to_encode, docs_per_s) is called after every batch.
+    The finished matrix is swapped in at the end. Returns {"docs", "reused", "encoded", "dropped"}.
+    """
+    if encode_map is None:
+        if encode is None:
+            raise ValueError("update_store needs encode or encode_map")
+        encode_map = _sequential_map(encode)
+
+    emb_dir.mkdir(parents=True, exist_ok=True)
+    texts = docs_df[text_col].fillna("").astype(str).tolist()
+    ids = docs_df[key_col].astype(str).tolist()
+    hashes = [doc_hash(i, t) for i, t in zip(ids, texts)]
+
+    old, old_row_of = _old_vectors(emb_dir, sig) if reuse else (None, {})
+    reuse_new, reuse_old, todo = _diff(hashes, old_row_of)
+    batches = plan_batches(todo, lengths, batch_size, token_budget)
+    plan = hashlib.blake2b(
+        json.dumps([sig.get("model"), hashes, batches]).encode("utf-8"), digest_size=16
+    ).hexdigest()
+
+    tmp_path = emb_dir / (EMB_FILE + ".tmp")
+    prog = read_progress(emb_dir)
+    if prog and prog.get("plan") == plan and tmp_path.exists() and _is_npy(tmp_path):
+        # resume an interrupted build of exactly this corpus
+        mm = np.lib.format.open_memmap(tmp_path, mode="r+")
+        done = set(prog.get("done_batches", []))
+    else:
+        if old is not None:
+            dim = int(old.shape[1])
+        else:
+            dim = int(next(iter(encode_map([(-1, texts[:1] or [""])])))[1].shape[1])
+        mm = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=DTYPE, shape=(len(texts), dim))
+
+        # copy unchanged vectors in chunks
+        reuse_new_a = np.asarray(reuse_new, dtype=np.int64)
+        reuse_old_a = np.asarray(reuse_old, dtype=np.int64)
+        step = 16384
+        for start in range(0, len(reuse_new_a), step):
+            mm[reuse_new_a[start : start + step]] = old[reuse_old_a[start : start + step]]
+        done = set()
+
+    def checkpoint(docs_per_s: float) -> None:
+        mm.flush()  # data first, then the marker that points at it
+        _write_progress(emb_dir, {
+            "plan": plan,
+            "done_batches": sorted(done),
+            "encoded": sum(len(batches[b]) for b in done),
+            "to_encode": len(todo),
+            "docs_per_s": round(docs_per_s, 2),
+            "updated": time.time(),
+        })
+
+    checkpoint(0.0)
+    resumed = sum(len(batches[b]) for b in done)
+    encoded = resumed
+    t0 = last_ck = time.perf_counter()
+    jobs = ((b, [texts[i] for i in batches[b]]) for b in range(len(batches)) if b not in done)
+    for batch_no, emb in encode_map(jobs):
+        rows = batches[batch_no]
+        mm[rows] = np.asarray(emb).astype(DTYPE)
+        done.add(batch_no)
+        encoded += len(rows)
+
+        now = time.perf_counter()
+        docs_per_s = (encoded - resumed) / max(now - t0, 1e-9)
+        if now - last_ck >= checkpoint_s:
+            checkpoint(docs_per_s)
+            last_ck = now
+        if progress is not None:
+            progress(encoded, len(todo), docs_per_s)
+
+    mm.flush()
+    dim = int(mm.shape[1])
+    del mm, old
+
+    # meta goes first and comes back last: a crash in between never pairs old hashes with new vectors
+    (emb_dir / META_FILE).unlink(missing_ok=True)
+    os.replace(tmp_path, emb_dir / EMB_FILE)
+    (emb_dir / IDS_FILE).write_text(json.dumps(ids, ensure_ascii=False), encoding="utf-8")
+    (emb_dir / HASHES_FILE).write_text(json.dumps(hashes), encoding="utf-8")
+    meta = dict(sig, format=FORMAT_VERSION, n=len(ids), dim=dim, dtype=np.dtype(DTYPE).name)
+    (emb_dir / META_FILE).write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+    (emb_dir / PROGRESS_FILE).unlink(missing_ok=True)
+
+    return {
+        "docs": len(ids),
+        "reused": len(reuse_new),
+        "encoded": len(todo),
+        "dropped": len(old_row_of) - len(set(reuse_old)),
+    }
+
+
+def open_or_build(emb_dir: Path, docs_path: Path, docs_df: pd.DataFrame, key_col: str, text_col: str,
+                  model: str, get_encoder: Callable[[], Any], batch_size: int = 128,
+                  force: bool = False, backend: str = LEGACY_BACKEND) -> tuple[np.memmap, list[str]]:
+    """
+    Shared entry point for the analysis scripts: open_store() for docs_path/model/columns,
+    after an in-process incremental update if the store is stale (force=True: full re-encode).
+    docs_df must be docs_path as read by pd.read_csv (store rows follow its row order).
+    get_encoder() is only called when something has to be encoded; `backend` is the encoder
+    backend it returns (a store built with another backend is re-encoded in full).
+    """
+    sig = docs_signature(docs_path, model, text_col, key_col, backend)
+    if force or not is_current(emb_dir, sig):
+        enc = get_encoder()
+        update_store(emb_dir, docs_df, key_col, text_col, sig,
+                     lambda texts: enc.encode(texts, normalize_embeddings=True),
+                     batch_size, reuse=not force)
+    return open_store(emb_dir)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Sentence encoder with a selectable CPU inference backend (EMB_BACKEND), used for query
+encoding in run_chatbot.py and document encoding in build_embeddings.py.
+
+- torch       SentenceTransformer in fp32 (default)
+- torch-int8  same model, nn.Linear weights dynamically quantized to int8
+- onnx        ONNX graph run by onnxruntime (sentence-transformers backend="onnx")
+- onnx-int8   ONNX graph with dynamically int8-quantized weights, exported once to out/encoder_onnx
+
+Every backend returns the same .encode(texts, normalize_embeddings=..., batch_size=...) API.
+Parity check against a torch fp32 reference encoding of sampled out/emb_cache documents
+(cosine per doc + query latency; cosine vs the stored vectors is reported next to it):
+    EMB_BACKEND=onnx-int8 python encoder.py
+"""
+import os
+import re
+import resource
+import time
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+BACKENDS = ["torch", "torch-int8", "onnx", "onnx-int8"]
+DEFAULT_BACKEND = "torch"
+# onnxruntime quantization preset: avx2 runs everywhere on x86; avx512_vnni / arm64 are faster where available
+ONNX_QCONFIG = os.environ.get("EMB_ONNX_QCONFIG", "avx2").strip() or "avx2"
+
+BASE = Path(__file__).parent
+EXPORT_DIR = BASE / "out" / "encoder_onnx"
+
+
+def backend_from_env() -> str:
+    backend = os.environ.get("EMB_BACKEND", DEFAULT_BACKEND).strip() or DEFAULT_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"EMB_BACKEND={backend!r}, expected one of {BACKENDS}")
+    return backend
+
+
+def _export_path(model_name: str) -> Path:
+    return EXPORT_DIR / re.sub(r"[^A-Za-z0-9_.-]+", "__", model_name)
+
+
+def _qint8_file() -> str:
+    return f"onnx/model_qint8_{ONNX_QCONFIG}.onnx"
+
+
+def prepare(model_name: str, backend: str) -> None:
+    """One-time export for onnx-int8 (call before starting workers, so they don't race on it)."""
+    if backend != "onnx-int8":
+        return
+    path = _export_path(model_name)
+    if (path / _qint8_file()).exists():
+        return
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    model = SentenceTransformer(model_name, backend="onnx", device="cpu")
+    model.save(str(path))
+    export_dynamic_quantized_onnx_model(model, ONNX_QCONFIG, str(path))
+
+
+def load_encoder(model_name: str, backend: str = DEFAULT_BACKEND) -> Any:
+    from sentence_transformers import SentenceTransformer
+
+    if backend == "torch":
+        return SentenceTransformer(model_name)
+    if backend == "torch-int8":
+        import torch
+
+        model = SentenceTransformer(model_name, device="cpu")
+        torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        return model
+    if backend == "onnx":
+        return SentenceTransformer(model_name, backend="onnx", device="cpu")
+    if backend == "onnx-int8":
+        prepare(model_name, backend)
+        return SentenceTransformer(str(_export_path(model_name)), backend="onnx", device="cpu",
+                                   model_kwargs={"file_name": _qint8_file()})
+    raise ValueError(f"Unknown encoder backend {backend!r}, expected one of {BACKENDS}")
+
+
+# -------------------------
+# Parity check
+# -------------------------
+def _max_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _query_latency(model: Any, queries: list[str]) -> float:
+    model.encode(queries[:1], normalize_embeddings=True)  # warm-up
+    t = time.perf_counter()
+    for text in queries:
+        model.encode([text], normalize_embeddings=True)
+    return (time.perf_counter() - t) / max(len(queries), 1)
+
+
+def encode_texts(model: Any, texts: list[str], batch_size: int = 32) -> np.ndarray:
+    return np.asarray(model.encode(texts, batch_size=batch_size, normalize_embeddings=True), dtype=np.float32)
+
+
+def parity(vecs: np.ndarray, ref_vecs: np.ndarray) -> dict[str, float]:
+    """Cosine between a backend's vectors and reference vectors of the same texts."""
+    ref = np.asarray(ref_vecs, dtype=np.float32)
+    ref /= np.maximum(np.linalg.norm(ref, axis=1, keepdims=True), 1e-12)
+    cos = np.sum(vecs * ref, axis=1)
+    return {"cos_mean": float(cos.mean()), "cos_p05": float(np.quantile(cos, 0.05)), "cos_min": float(cos.min())}
+
+
+def main():
+    import pandas as pd
+
+    import emb_store
+
+    emb_dir = BASE / "out" / "emb_cache"
+    docs_path = BASE / "out" / "courses_documents.csv"
+    backend = backend_from_env()
+    n_docs = int(os.environ.get("PARITY_DOCS", "256"))
+
+    meta = emb_store.read_meta(emb_dir)
+    if not meta:
+        raise SystemExit(f"Puudub embeddingute store: {emb_dir} (käivita build_embeddings.py)")
+    doc_embs, ids = emb_store.open_store(emb_dir)
+    docs = pd.read_csv(docs_path)
+    text_of = dict(zip(docs[meta["key_col"]].astype(str), docs[meta["text_col"]].fillna("").astype(str)))
+
+    rng = np.random.default_rng(0)
+    rows = np.sort(rng.choice(len(ids), size=min(n_docs, len(ids)), replace=False))
+    rows = np.asarray([r for r in rows if ids[r] in text_of], dtype=np.int64)
+    texts = [text_of[ids[r]] for r in rows]
+    # short prompts for latency: first words of the sampled docs
+    queries = [" ".join(t.split()[:12]) for t in texts[:50]]
+
+    rss0 = _max_rss_mb()
+    t = time.perf_counter()
+    model = load_encoder(meta["model"], backend)
+    t_load = time.perf_counter() - t
+    rss1 = _max_rss_mb()
+
+    vecs = encode_texts(model, texts)
+    t_query = _query_latency(model, queries)
+    del model
+
+    # reference: the same texts through torch fp32, whatever backend the store was built with
+    ref = load_encoder(meta["model"], "torch")
+    ref_vecs = vecs if backend == "torch" else encode_texts(ref, texts)
+    res = parity(vecs, ref_vecs)
+    stored = parity(vecs, doc_embs[rows])
+    store_backend = emb_store.store_backend(meta)
+
+    print(f"Backend: {backend}, model: {meta['model']}, docs: {len(rows)}")
+    print(f"cosine vs torch fp32: mean {res['cos_mean']:.5f}, p05 {res['cos_p05']:.5f}, min {res['cos_min']:.5f}")
+    print(f"cosine vs store ({store_backend}, float16): mean {stored['cos_mean']:.5f}, "
+          f"p05 {stored['cos_p05']:.5f}, min {stored['cos_min']:.5f}")
+    print(f"load {t_load:.2f} s, peak RSS +{rss1 - rss0:.0f} MB, query encode {t_query * 1000:.1f} ms")
+    if backend != "torch":
+        print(f"torch fp32 query encode {_query_latency(ref, queries) * 1000:.1f} ms")
+    if store_backend != backend:
+        print(f"[WARN] store on ehitatud backendiga {store_backend}: päringud ja dokumendid pärinevad eri "
+              f"backendidest (run_chatbot.py nõuab ümberehitust EMB_BACKEND={backend} jaoks)")
+
+if __name__ == "__main__":
+    main()
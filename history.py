@@ -0,0 +1,132 @@
+"""
+Conversation history compaction for the chat path (what goes between the system prompt and
+the current question in messages_to_send).
+
+- while the whole history fits under the token ceiling it is sent verbatim (no summary at all)
+- otherwise the last `keep_turns` turns (user + assistant) are sent verbatim and older messages
+  as a rolling summary, cached in the session state, so each message is summarized once
+  (previous summary + newly dropped messages -> new summary)
+- the summary is refreshed by refresh_summary() after the answer was streamed, so the summary LLM
+  call never delays the answer; compact_history() itself makes no LLM call (messages not yet in
+  the summary are stood in for by the extractive summary)
+- the history portion has a hard token ceiling: oldest verbatim messages are dropped first,
+  then the summary is cut
+Token counts are the ~4 chars/token estimate also used for cost reporting.
+"""
+import time
+from typing import Any, Callable
+
+HISTORY_KEEP_TURNS = 3
+HISTORY_MAX_TOKENS = 2000
+SUMMARY_PREFIX = "Varasema vestluse kokkuvõte:\n"
+
+Message = dict[str, str]
+Summarizer = Callable[[str, list[Message]], str]
+
+
+def approx_tokens(text: str) -> int:
+    return max(1, len(text) // 4) if text else 0
+
+
+def messages_tokens(messages: list[Message]) -> int:
+    # + ~4 tokens of per-message chat framing
+    return sum(approx_tokens(m.get("content", "")) + 4 for m in messages)
+
+
+def extractive_summary(prev: str, messages: list[Message], per_msg_chars: int = 200) -> str:
+    """LLM-free fallback: previous summary + the start of every dropped message."""
+    lines = [prev] if prev else []
+    for m in messages:
+        text = " ".join(str(m.get("content", "")).split())
+        if text:
+            who = "Kasutaja" if m.get("role") == "user" else "Assistent"
+            lines.append(f"{who}: {text[:per_msg_chars]}{'…' if len(text) > per_msg_chars else ''}")
+    return "\n".join(lines)
+
+
+def _split(history: list[Message], state: dict[str, Any], keep_turns: int) -> tuple[list[Message], list[Message]]:
+    keep = max(0, 2 * int(keep_turns))
+    older = history[:-keep] if keep else list(history)
+    recent = history[-keep:] if keep else []
+    if state.get("upto", 0) > len(older):
+        # conversation was reset
+        state.clear()
+    return older, recent
+
+
+def compact_history(history: list[Message], state: dict[str, Any],
+                    keep_turns: int = HISTORY_KEEP_TURNS,
+                    max_tokens: int = HISTORY_MAX_TOKENS) -> tuple[list[Message], dict[str, Any]]:
+    """
+    history: earlier messages (role/content), without the current question.
+    state: per-session dict holding {"summary", "upto"} (messages already folded into the summary).
+    Returns (messages to send, {"history_tokens", "history_tokens_full", "history_tokens_saved",
+    "history_summarized", "history_dropped"}).
+    """
+    full = messages_tokens(history)
+    if full <= max_tokens:
+        state.clear()
+        return list(history), {
+            "history_tokens": full,
+            "history_tokens_full": full,
+            "history_tokens_saved": 0,
+            "history_summarized": 0,
+            "history_dropped": 0,
+        }
+
+    older, recent = _split(history, state, keep_turns)
+    summary = state.get("summary", "")
+    upto = state.get("upto", 0)
+    if len(older) > upto:
+        summary = extractive_summary(summary, older[upto:])
+
+    out = list(recent)
+    dropped = 0
+    summary_msg = {"role": "system", "content": SUMMARY_PREFIX + summary} if summary else None
+
+    def total() -> int:
+        return messages_tokens(out) + (messages_tokens([summary_msg]) if summary_msg else 0)
+
+    while out and total() > max_tokens:
+        out.pop(0)
+        dropped += 1
+    if summary_msg and total() > max_tokens:
+        room_chars = max(0, (max_tokens - messages_tokens(out) - 4) * 4 - len(SUMMARY_PREFIX))
+        summary_msg = {"role": "system", "content": SUMMARY_PREFIX + summary[-room_chars:]} if room_chars > 0 else None
+    if summary_msg:
+        out.insert(0, summary_msg)
+
+    sent = messages_tokens(out)
+    return out, {
+        "history_tokens": sent,
+        "history_tokens_full": full,
+        "history_tokens_saved": max(0, full - sent),
+        "history_summarized": len(older),
+        "history_dropped": dropped,
+    }
+
+
+def refresh_summary(history: list[Message], state: dict[str, Any], summarize: Summarizer | None = None,
+                    keep_turns: int = HISTORY_KEEP_TURNS,
+                    max_tokens: int = HISTORY_MAX_TOKENS) -> dict[str, Any]:
+    """
+    Call after the answer was streamed, with the history including the new turn: folds messages that
+    left the verbatim window into state["summary"] (summarize(prev, new), extractive on failure),
+    only once the history no longer fits under max_tokens.
+    Returns {"t_summary_s", "history_summary_llm"}, or {} if nothing had to be summarized.
+    """
+    if messages_tokens(history) <= max_tokens:
+        return {}
+    older, _ = _split(history, state, keep_turns)
+    upto = state.get("upto", 0)
+    if len(older) <= upto:
+        return {}
+    prev, new = state.get("summary", ""), older[upto:]
+    t = time.perf_counter()
+    llm = summarize is not None
+    try:
+        summary = summarize(prev, new) if summarize else extractive_summary(prev, new)
+    except Exception:
+        summary, llm = extractive_summary(prev, new), False
+    state["summary"], state["upto"] = summary, len(older)
+    return {"t_summary_s": round(time.perf_counter() - t, 4), "history_summary_llm": llm}
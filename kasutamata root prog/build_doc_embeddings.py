@@ -1,13 +1,20 @@
 #!/usr/bin/env python3
-import json
+"""
+In-process build of the shared embedding store (out/emb_cache, emb_store.py format).
+Same files as run_chatbot.py / the analysis scripts; big rebuilds: python build_embeddings.py.
+"""
+import os
+import sys
 from pathlib import Path
 
-import numpy as np
 import pandas as pd
-from sentence_transformers import SentenceTransformer
 
+BASE = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE))
+
+import emb_store  # noqa: E402
+from encoder import backend_from_env, load_encoder  # noqa: E402
 
-BASE = Path(__file__).parent
 DOCS_PATH = BASE / "out" / "courses_documents.csv"
 OUT_DIR = BASE / "out" / "emb_cache"
 OUT_DIR.mkdir(parents=True, exist_ok=True)
@@ -15,51 +22,33 @@ OUT_DIR.mkdir(parents=True, exist_ok=True)
 # Pane siia SAMA mudel, mis su rakenduses
 EMBED_MODEL = "intfloat/multilingual-e5-small"
 
+DOC_KEY_COL = "course_uuid"
 DOC_TEXT_COL = "document_text"
 
 BATCH = 64
-DTYPE = np.float16  # väiksem fail; kui tahad täpsem, pane np.float32
 
 
 def main():
     if not DOCS_PATH.exists():
         raise SystemExit(f"Puudub: {DOCS_PATH}")
 
-    docs = pd.read_csv(DOCS_PATH).fillna("")
-    if DOC_TEXT_COL not in docs.columns:
-        raise SystemExit(f"courses_documents.csv puudub veerg: {DOC_TEXT_COL}")
-
-    texts = docs[DOC_TEXT_COL].astype(str).tolist()
+    docs = pd.read_csv(DOCS_PATH)
+    for col in [DOC_KEY_COL, DOC_TEXT_COL]:
+        if col not in docs.columns:
+            raise SystemExit(f"courses_documents.csv puudub veerg: {col}")
 
-    embedder = SentenceTransformer(EMBED_MODEL)
-    embs = embedder.encode(
-        texts,
+    force = os.environ.get("REBUILD_EMB", "").strip() == "1"
+    backend = backend_from_env()
+    mm, ids = emb_store.open_or_build(
+        OUT_DIR, DOCS_PATH, docs, DOC_KEY_COL, DOC_TEXT_COL, EMBED_MODEL,
+        lambda: load_encoder(EMBED_MODEL, backend),
         batch_size=BATCH,
-        normalize_embeddings=True,
-        show_progress_bar=True,
+        force=force,
+        backend=backend,
     )
-    embs = np.asarray(embs, dtype=DTYPE)
-
-    mmap_path = OUT_DIR / "doc_embs.mmap"
-    meta_path = OUT_DIR / "doc_embs_meta.json"
-
-    # kirjuta memmap
-    mm = np.memmap(mmap_path, dtype=DTYPE, mode="w+", shape=embs.shape)
-    mm[:] = embs[:]
-    mm.flush()
-
-    meta = {
-        "model": EMBED_MODEL,
-        "dtype": str(DTYPE),
-        "shape": [int(embs.shape[0]), int(embs.shape[1])],
-        "docs_path": str(DOCS_PATH),
-        "text_col": DOC_TEXT_COL,
-    }
-    meta_path.write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
 
-    print(f"Valmis: {mmap_path}")
-    print(f"Valmis: {meta_path}")
+    print(f"Valmis: {OUT_DIR / emb_store.EMB_FILE} ({mm.shape[0]} x {mm.shape[1]}, {mm.dtype})")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
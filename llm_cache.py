@@ -0,0 +1,130 @@
+"""
+Exact-request LLM response cache on disk (SQLite, out/llm_cache.sqlite).
+
+The key is a SHA-256 of the full request payload (model, messages and every other
+generation parameter, canonical JSON), so only byte-identical requests share an answer.
+The complete response text and token usage are stored.
+
+Modes (LLM_CACHE_MODE):
+- use      read on hit, call + store on miss (default)
+- refresh  always call, overwrite the stored answer
+- bypass   always call, neither read nor write
+"""
+import asyncio
+import hashlib
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Iterator
+
+CACHE_MODES = ["use", "refresh", "bypass"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_responses (
+    key          TEXT PRIMARY KEY,
+    model        TEXT NOT NULL,
+    request_json TEXT NOT NULL,
+    response     TEXT NOT NULL,
+    usage_in     INTEGER,
+    usage_out    INTEGER,
+    created      REAL NOT NULL,
+    hits         INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+
+def request_key(payload: dict[str, Any]) -> str:
+    canon = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canon.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute(SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # one short-lived connection per call (one transaction): safe across Streamlit threads and processes
+        con = sqlite3.connect(self.path, timeout=30)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def get(self, key: str) -> dict[str, Any] | None:
+        with self._connect() as con:
+            row = con.execute(
+                "SELECT response, usage_in, usage_out, created FROM llm_responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            con.execute("UPDATE llm_responses SET hits = hits + 1 WHERE key = ?", (key,))
+        return {"response": row[0], "usage_in": row[1], "usage_out": row[2], "created": row[3]}
+
+    def put(self, key: str, payload: dict[str, Any], response: str,
+            usage_in: int | None, usage_out: int | None) -> None:
+        with self._connect() as con:
+            con.execute(
+                "INSERT OR REPLACE INTO llm_responses "
+                "(key, model, request_json, response, usage_in, usage_out, created, hits) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+                (key, str(payload.get("model", "")), json.dumps(payload, ensure_ascii=False),
+                 response, usage_in, usage_out, time.time()),
+            )
+
+    def stats(self) -> dict[str, int]:
+        with self._connect() as con:
+            n, hits = con.execute("SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM llm_responses").fetchone()
+        return {"size": int(n), "hits": int(hits)}
+
+
+def cached_completion(cache: LLMResponseCache | None, mode: str, payload: dict[str, Any],
+                      call: Callable[[dict[str, Any]], tuple[str, int | None, int | None]]
+                      ) -> tuple[str, int | None, int | None, bool]:
+    """
+    call(payload) -> (response text, usage_in, usage_out) runs on a miss or in refresh/bypass mode.
+    Returns (response text, usage_in, usage_out, cache_hit).
+    """
+    if mode not in CACHE_MODES:
+        raise ValueError(f"LLM cache mode {mode!r}, expected one of {CACHE_MODES}")
+    if cache is None or mode == "bypass":
+        return (*call(payload), False)
+
+    key = request_key(payload)
+    if mode == "use":
+        hit = cache.get(key)
+        if hit is not None:
+            return hit["response"], hit["usage_in"], hit["usage_out"], True
+
+    text, usage_in, usage_out = call(payload)
+    if text:
+        cache.put(key, payload, text, usage_in, usage_out)
+    return text, usage_in, usage_out, False
+
+
+async def acached_completion(cache: LLMResponseCache | None, mode: str, payload: dict[str, Any],
+                             call: Callable[[dict[str, Any]], Awaitable[tuple[str, int | None, int | None]]]
+                             ) -> tuple[str, int | None, int | None, bool]:
+    """cached_completion() for an async call; SQLite reads/writes run in a worker thread."""
+    if mode not in CACHE_MODES:
+        raise ValueError(f"LLM cache mode {mode!r}, expected one of {CACHE_MODES}")
+    if cache is None or mode == "bypass":
+        return (*(await call(payload)), False)
+
+    key = request_key(payload)
+    if mode == "use":
+        hit = await asyncio.to_thread(cache.get, key)
+        if hit is not None:
+            return hit["response"], hit["usage_in"], hit["usage_out"], True
+
+    text, usage_in, usage_out = await call(payload)
+    if text:
+        await asyncio.to_thread(cache.put, key, payload, text, usage_in, usage_out)
+    return text, usage_in, usage_out, False
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Process-wide OpenAI-compatible LLM client (run_chatbot.py creates it once via st.cache_resource).
+
+One httpx connection pool with keep-alive is reused by every request, so TCP/TLS setup is paid
+once instead of per message. Pool size, keep-alive, timeouts and retries come from env:
+LLM_POOL_SIZE, LLM_KEEPALIVE_S, LLM_CONNECT_TIMEOUT_S, LLM_READ_TIMEOUT_S, LLM_MAX_RETRIES.
+warm_up() opens a pooled connection at startup. make_async_client() is the asyncio variant
+(one per event loop: httpx async pools are bound to the loop that created them).
+
+Time-to-first-token, fresh client per request vs pooled (e.g. against analysis/llm_stub.py):
+    python analysis/llm_stub.py &
+    LLM_BASE_URL=http://127.0.0.1:8765/v1 python llm_client.py
+"""
+import os
+import time
+from typing import Any
+
+import httpx
+from openai import APIConnectionError, AsyncOpenAI, OpenAI
+
+POOL_SIZE = int(os.environ.get("LLM_POOL_SIZE", "10"))
+KEEPALIVE_S = float(os.environ.get("LLM_KEEPALIVE_S", "120"))
+CONNECT_TIMEOUT_S = float(os.environ.get("LLM_CONNECT_TIMEOUT_S", "5"))
+READ_TIMEOUT_S = float(os.environ.get("LLM_READ_TIMEOUT_S", "60"))
+MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "2"))
+
+
+def request_timeout(read_s: float = READ_TIMEOUT_S) -> httpx.Timeout:
+    """Per-request timeout: connect is short, read bounds the gap between streamed chunks."""
+    return httpx.Timeout(read_s, connect=CONNECT_TIMEOUT_S)
+
+
+def make_client(base_url: str, api_key: str, pool_size: int = POOL_SIZE,
+                keepalive_s: float = KEEPALIVE_S, max_retries: int = MAX_RETRIES) -> OpenAI:
+    http = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive_s,
+        ),
+        timeout=request_timeout(),
+    )
+    return OpenAI(base_url=base_url, api_key=api_key, http_client=http,
+                  timeout=request_timeout(), max_retries=max_retries)
+
+
+def make_async_client(base_url: str, api_key: str, pool_size: int = POOL_SIZE,
+                      keepalive_s: float = KEEPALIVE_S, max_retries: int = MAX_RETRIES) -> AsyncOpenAI:
+    http = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive_s,
+        ),
+        timeout=request_timeout(),
+    )
+    return AsyncOpenAI(base_url=base_url, api_key=api_key, http_client=http,
+                       timeout=request_timeout(), max_retries=max_retries)
+
+
+def warm_up(client: OpenAI) -> dict[str, Any]:
+    """
+    Opens a pooled connection (DNS + TCP + TLS) before the first chat request.
+    Any HTTP answer counts: a 401/404 from /models still leaves the connection in the pool.
+    """
+    t = time.perf_counter()
+    ok = True
+    try:
+        client.with_options(max_retries=0, timeout=request_timeout(CONNECT_TIMEOUT_S)).models.list()
+    except APIConnectionError:  # includes timeouts: nothing was opened
+        ok = False
+    except Exception:
+        pass
+    return {"llm_warmup_s": round(time.perf_counter() - t, 4), "llm_warmup_ok": ok}
+
+
+def time_to_first_token(client: OpenAI, model: str, prompt: str) -> float:
+    t = time.perf_counter()
+    stream = client.chat.completions.create(
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        stream=True,
+    )
+    ttft = float("nan")
+    for event in stream:
+        if ttft != ttft and getattr(event, "choices", None) and event.choices[0].delta.content:
+            ttft = time.perf_counter() - t
+    return ttft
+
+
+def main():
+    base_url = os.environ.get("LLM_BASE_URL", "http://127.0.0.1:8765/v1")
+    api_key = os.environ.get("OPENROUTER_API_KEY", "stub")
+    model = os.environ.get("LLM_MODEL", "google/gemma-3-27b-it")
+    n = int(os.environ.get("LLM_BENCH_N", "20"))
+
+    fresh = []
+    for i in range(n):
+        fresh.append(time_to_first_token(OpenAI(base_url=base_url, api_key=api_key), model, f"päring {i}"))
+
+    client = make_client(base_url, api_key)
+    info = warm_up(client)
+    pooled = [time_to_first_token(client, model, f"päring {i}") for i in range(n)]
+
+    def ms(xs: list[float]) -> str:
+        return f"first {xs[0] * 1000:.1f} ms, median {sorted(xs)[len(xs) // 2] * 1000:.1f} ms"
+
+    print(f"LLM: {base_url}, requests: {n}")
+    print(f"TTFT fresh client per request: {ms(fresh)}")
+    print(f"TTFT pooled client:            {ms(pooled)} (warm-up {info['llm_warmup_s'] * 1000:.1f} ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Buffered log writer: one background thread owns all log outputs (CSV files such as
+tagasiside_log.csv, and sinks such as the query_log.py SQLite store), so request threads never wait
+on disk I/O and rows from concurrent sessions never interleave.
+
+- write() (CSV row) and submit() (sink record) only enqueue (bounded queue; when it is full the row
+  is dropped and counted, never blocks)
+- the writer thread flushes a batch when `batch_size` rows are waiting or `flush_interval_s` passed,
+  opening each file once per batch / calling sink.write_rows(records) once per batch
+- a file that reached `max_bytes` is rotated first (log.csv -> log.csv.1 -> ... -> log.csv.<backups>),
+  the new file starts with the header again
+- flush() blocks until every row written before the call is on disk (tests, before reading a log)
+- a failed write is counted in stats()["errors"] (the batch is lost); the first failure is logged
+"""
+import atexit
+import csv
+import logging
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+LOG_QUEUE_SIZE = 10000
+LOG_BATCH_SIZE = 200
+LOG_FLUSH_INTERVAL_S = 1.0
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUPS = 5
+
+
+class CSVLogWriter:
+    def __init__(self, max_queue: int = LOG_QUEUE_SIZE, batch_size: int = LOG_BATCH_SIZE,
+                 flush_interval_s: float = LOG_FLUSH_INTERVAL_S, max_bytes: int = LOG_MAX_BYTES,
+                 backups: int = LOG_BACKUPS):
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval_s = float(flush_interval_s)
+        self.max_bytes = int(max_bytes)
+        self.backups = max(0, int(backups))
+        # items: (path, header, row), (sink, None, record), a threading.Event (flush marker) or None (stop)
+        self._q: queue.Queue = queue.Queue(maxsize=max(1, int(max_queue)))
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        self.errors = 0
+        self._thread = threading.Thread(target=self._loop, name="csv-log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, path: str | Path, header: list[str], row: list[Any]) -> bool:
+        """Enqueues one CSV row; False if the queue was full (row dropped)."""
+        return self._put((str(path), list(header), list(row)))
+
+    def submit(self, sink: Any, record: Any) -> bool:
+        """Enqueues one record for sink.write_rows(); False if the queue was full (record dropped)."""
+        return self._put((sink, None, record))
+
+    def _put(self, item: tuple[Any, list[str] | None, Any]) -> bool:
+        try:
+            self._q.put_nowait(item)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def flush(self, timeout: float | None = None) -> bool:
+        """Blocks until rows enqueued before this call are written. False on timeout or stopped writer."""
+        if not self._thread.is_alive():
+            return False
+        done = threading.Event()
+        try:
+            self._q.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def close(self, timeout: float = 10.0):
+        if self._thread.is_alive():
+            self._q.put(None)
+            self._thread.join(timeout)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "queued": self._q.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "rotations": self.rotations,
+            "errors": self.errors,
+        }
+
+    def _loop(self):
+        while True:
+            item = self._q.get()
+            batch: list[tuple[Any, list[str] | None, Any]] = []
+            markers: list[threading.Event] = []
+            stop = False
+            deadline = time.monotonic() + self.flush_interval_s
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    # everything before the marker must be written before it is set
+                    markers.append(item)
+                else:
+                    batch.append(item)
+                if stop or markers or len(batch) >= self.batch_size:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._q.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except Exception as exc:
+                    # never let one bad batch stop the writer thread
+                    self._failed("batch", len(batch), exc)
+            for ev in markers:
+                ev.set()
+            if stop:
+                return
+
+    def _write_batch(self, batch: list[tuple[Any, list[str] | None, Any]]):
+        by_target: dict[Any, list[tuple[list[str] | None, Any]]] = {}
+        for target, header, row in batch:
+            by_target.setdefault(target, []).append((header, row))
+        for target, rows in by_target.items():
+            if not isinstance(target, str):
+                try:
+                    target.write_rows([rec for _, rec in rows])
+                    self.written += len(rows)
+                except Exception as exc:
+                    self._failed(target, len(rows), exc)
+                continue
+            path = target
+            try:
+                self._rotate_if_needed(path)
+                new_file = not os.path.isfile(path) or os.path.getsize(path) == 0
+                with open(path, "a", newline="", encoding="utf-8") as f:
+                    w = csv.writer(f)
+                    if new_file:
+                        w.writerow(rows[0][0])
+                    w.writerows(row for _, row in rows)
+                self.written += len(rows)
+            except Exception as exc:
+                self._failed(path, len(rows), exc)
+
+    def _failed(self, target: Any, n_rows: int, exc: BaseException):
+        self.errors += 1
+        if self.errors == 1:
+            logging.warning("Log writer: %d rows for %r lost (%s: %s); further failures are only counted",
+                            n_rows, target, type(exc).__name__, exc)
+
+    def _rotate_if_needed(self, path: str):
+        if self.max_bytes <= 0:
+            return
+        try:
+            if os.path.getsize(path) < self.max_bytes:
+                return
+        except OSError:
+            return
+        if self.backups == 0:
+            os.remove(path)
+        else:
+            for i in range(self.backups - 1, 0, -1):
+                src = f"{path}.{i}"
+                if os.path.exists(src):
+                    os.replace(src, f"{path}.{i + 1}")
+            os.replace(path, f"{path}.1")
+        self.rotations += 1
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+int8 scalar-quantized copy of the embedding store (doc_embs_i8.dat), 2x smaller than float16.
+
+Each dimension d is stored as round(x_d / scale_d) with scale_d = max|x_d| / 127. The scale is
+folded into the query once (x . q ~= codes . (scale * q)), so the first pass never dequantizes
+document vectors. The best `rerank` candidates are then re-scored against the float16 vectors.
+
+Run directly to measure recall@10 against the exact float16 scorer, with the prompts of
+out/analysis/random_testcases.csv encoded exactly as run_chatbot.encode_query does (sanitized, no prefix):
+    python quant_store.py
+    RECALL_TESTCASES=path/to/cases.csv RECALL_QUERY_PREFIX="query: " python quant_store.py
+"""
+import json
+import os
+import time
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+import emb_store
+from retrieval import FULL_SCAN_MIN_SELECTIVITY, sanitize_user_text, score_rows, top_k_positions
+
+CODES_FILE = "doc_embs_i8.dat"
+META_FILE = "i8_meta.json"
+I8_FILES = [CODES_FILE, META_FILE]
+RERANK_N = 200
+I8_SCORE_CHUNK = 2048
+
+
+class Int8Store:
+    def __init__(self, codes: np.ndarray, scale: np.ndarray):
+        self.codes = codes                               # (n, dim) int8
+        self.scale = scale.astype(np.float32)            # (dim,)
+        self.n, self.dim = (int(x) for x in codes.shape)
+
+    @classmethod
+    def build(cls, doc_embs: np.ndarray, out_dir: Path, signature: dict[str, Any],
+              chunk: int = 16384) -> "Int8Store":
+        n, dim = (int(x) for x in doc_embs.shape)
+        absmax = np.zeros(dim, dtype=np.float32)
+        for start in range(0, n, chunk):
+            emb = np.abs(np.asarray(doc_embs[start : start + chunk], dtype=np.float32))
+            np.maximum(absmax, emb.max(axis=0), out=absmax)
+        scale = np.maximum(absmax, 1e-12) / 127.0
+
+        path = out_dir / CODES_FILE
+        if path.exists():
+            path.unlink()
+        mm = np.memmap(path, mode="w+", dtype=np.int8, shape=(n, dim))
+        for start in range(0, n, chunk):
+            emb = np.asarray(doc_embs[start : start + chunk], dtype=np.float32)
+            mm[start : start + len(emb)] = np.clip(np.rint(emb / scale), -127, 127).astype(np.int8)
+        mm.flush()
+
+        meta = {"signature": signature, "n": n, "dim": dim, "scale": scale.tolist()}
+        (out_dir / META_FILE).write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+        return cls(np.memmap(path, mode="r", dtype=np.int8, shape=(n, dim)), scale)
+
+    @classmethod
+    def load(cls, out_dir: Path, signature: dict[str, Any]) -> "Int8Store | None":
+        """None if the files are missing or were built for another embedding store."""
+        if not all((out_dir / f).exists() for f in I8_FILES):
+            return None
+        try:
+            meta = json.loads((out_dir / META_FILE).read_text(encoding="utf-8"))
+        except Exception:
+            return None
+        if meta.get("signature") != signature:
+            return None
+        n, dim = int(meta["n"]), int(meta["dim"])
+        codes = np.memmap(out_dir / CODES_FILE, mode="r", dtype=np.int8, shape=(n, dim))
+        return cls(codes, np.asarray(meta["scale"], dtype=np.float32))
+
+    def approx_scores(self, idxs: np.ndarray, q: np.ndarray,
+                      full_min: float = FULL_SCAN_MIN_SELECTIVITY) -> tuple[np.ndarray, str, float]:
+        scores, path, selectivity = self.score_codes(idxs, q, full_min)
+        return scores[:, 0], path, selectivity
+
+    def score_codes(self, idxs: np.ndarray, Q: np.ndarray, full_min: float = FULL_SCAN_MIN_SELECTIVITY,
+                    chunk: int = I8_SCORE_CHUNK) -> tuple[np.ndarray, str, float]:
+        """
+        int8 first-pass scores (len(idxs) x n_queries), path picked as in retrieval.scores_for.
+        Codes are upcast `chunk` rows at a time into one reused float32 buffer.
+        """
+        Qs = np.asarray(Q, dtype=np.float32).reshape(-1, self.dim) * self.scale
+        selectivity = len(idxs) / self.n if self.n else 0.0
+        full = bool(len(idxs)) and selectivity >= full_min
+        n_rows = self.n if full else len(idxs)
+        out = np.empty((n_rows, len(Qs)), dtype=np.float32)
+        buf = np.empty((min(chunk, max(n_rows, 1)), self.dim), dtype=np.float32)
+        for start in range(0, n_rows, chunk):
+            part = self.codes[start : start + chunk] if full else self.codes[idxs[start : start + chunk]]
+            b = buf[: len(part)]
+            np.copyto(b, part)
+            np.matmul(b, Qs.T, out=out[start : start + len(part)])
+        if full:
+            return out[idxs], "full", selectivity
+        return out, "gather", selectivity
+
+    def search(self, doc_embs: np.ndarray, q: np.ndarray, idxs: np.ndarray, k: int,
+               rerank: int = RERANK_N, full_min: float = FULL_SCAN_MIN_SELECTIVITY
+               ) -> tuple[np.ndarray, np.ndarray, int, str, float]:
+        """
+        int8 first pass over idxs, float re-rank of the best `rerank`.
+        Returns (rows, scores, docs_scored, first-pass path, selectivity).
+        """
+        approx, path, selectivity = self.approx_scores(idxs, q, full_min)
+        cand = np.sort(idxs[top_k_positions(approx, max(k, rerank))])
+        scores = score_rows(doc_embs, cand, q)[:, 0]
+        top = top_k_positions(scores, k)
+        return cand[top], scores[top], int(len(idxs)), path, selectivity
+
+
+def recall_at_k(store: Int8Store, doc_embs: np.ndarray, queries: np.ndarray, k: int = 10,
+                rerank: int = RERANK_N) -> dict[str, float]:
+    """Mean recall@k of int8+re-rank vs the exact float16 scorer, plus mean latency of both."""
+    idxs = np.arange(len(doc_embs), dtype=np.int64)
+    hits, t_exact, t_i8 = [], 0.0, 0.0
+    for q in queries:
+        t0 = time.perf_counter()
+        exact = idxs[top_k_positions(score_rows(doc_embs, idxs, q)[:, 0], k)]
+        t1 = time.perf_counter()
+        approx = store.search(doc_embs, q, idxs, k, rerank)[0]
+        t2 = time.perf_counter()
+        hits.append(len(set(exact.tolist()) & set(approx.tolist())) / max(len(exact), 1))
+        t_exact += t1 - t0
+        t_i8 += t2 - t1
+    n = max(len(queries), 1)
+    return {"recall": float(np.mean(hits)), "t_exact_s": t_exact / n, "t_int8_s": t_i8 / n}
+
+
+def load_queries(path: Path, model_name: str, prefix: str, n: int = 200) -> np.ndarray:
+    """Prompts of a test-case CSV (Päring), encoded with the configured EMB_BACKEND encoder."""
+    import pandas as pd
+
+    from encoder import backend_from_env, load_encoder
+
+    prompts = [sanitize_user_text(p) for p in pd.read_csv(path)["Päring"].dropna().astype(str)]
+    prompts = [p for p in dict.fromkeys(prompts) if p][:n]
+    if not prompts:
+        raise SystemExit(f"Päringuid pole: {path}")
+    model = load_encoder(model_name, backend_from_env())
+    vecs = model.encode([prefix + p for p in prompts], batch_size=32, normalize_embeddings=True)
+    return np.asarray(vecs, dtype=np.float32)
+
+
+def main():
+    base = Path(__file__).parent
+    emb_dir = base / "out" / "emb_cache"
+    emb_path = emb_dir / emb_store.EMB_FILE
+    cases_path = Path(os.environ.get("RECALL_TESTCASES", str(base / "out" / "analysis" / "random_testcases.csv")))
+    prefix = os.environ.get("RECALL_QUERY_PREFIX", "")
+    sig = emb_store.read_meta(emb_dir)
+    if not sig:
+        raise SystemExit(f"Puudub embeddingute store: {emb_dir} (käivita build_embeddings.py)")
+    if not cases_path.exists():
+        raise SystemExit(f"Puudub: {cases_path}")
+    doc_embs, _ = emb_store.open_store(emb_dir)
+    n, dim = (int(x) for x in doc_embs.shape)
+    store = Int8Store.load(emb_dir, sig) or Int8Store.build(doc_embs, emb_dir, sig)
+
+    queries = load_queries(cases_path, sig["model"], prefix)
+
+    res = recall_at_k(store, doc_embs, queries)
+    print(f"Docs: {n}, dim: {dim}, queries: {len(queries)} ({cases_path.name}, prefix {prefix!r})")
+    print(f"float16: {emb_path.stat().st_size / 1e6:.2f} MB, int8: {(emb_dir / CODES_FILE).stat().st_size / 1e6:.2f} MB")
+    print(f"recall@10 (int8 + re-rank {RERANK_N}): {res['recall']:.4f}")
+    print(f"mean scan: exact {res['t_exact_s'] * 1000:.2f} ms, int8 {res['t_int8_s'] * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
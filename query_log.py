@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Typed query log (SQLite, out/query_log.sqlite) instead of a JSON blob in vigade_log.csv.
+
+One row per log_attempt(): query, filters, step, status, the analysis run id (NULL = live chat)
+and the pipeline metrics as real columns (filtered_count, docs_scored, top_codes, t_*_s,
+usage_*, cache flags, ...). Detail keys without a column are kept in extra_json.
+Indexed on time, query text + filters, filters and run id.
+
+- read_log(): one SELECT into a DataFrame with the vigade_log column names
+  (Aeg, Päring, Filtrid, Samm, Tulemus) + typed metric columns, top_codes as lists
+  (stored as a JSON array, so codes may contain any character)
+- load_log(): read_log() if the store exists, else the same frame from an old vigade_log.csv
+- to_csv_layout(): back to Aeg, Päring, Filtrid, Samm, Tulemus, DetailidJSON
+
+    python query_log.py export out/vigade_log.csv [--run-id ID] [--since "2026-01-01"]
+    python query_log.py import out/vigade_log.csv      # migrate an old CSV log
+"""
+import argparse
+import json
+import sqlite3
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator
+
+import pandas as pd
+
+CSV_COLUMNS = ["Aeg", "Päring", "Filtrid", "Samm", "Tulemus", "DetailidJSON"]
+BASE_COLUMNS = {"ts": "Aeg", "query": "Päring", "filters": "Filtrid", "step": "Samm", "status": "Tulemus"}
+
+INT_COLUMNS = [
+    "filtered_count", "docs_scored", "top_k", "usage_in", "usage_out", "llm_retries",
+    "context_tokens", "context_docs", "context_docs_truncated", "history_tokens", "history_tokens_saved",
+    "answer_cache_saved_in", "answer_cache_saved_out", "llm_cache_saved_in", "llm_cache_saved_out",
+]
+REAL_COLUMNS = [
+    "selectivity", "t_meta_s", "t_embed_s", "t_score_s", "t_rag_s", "t_llm_s", "t_ttft_s", "t_wall_s",
+    "t_overlap_s", "emb_load_s", "answer_cache_sim",
+]
+TEXT_COLUMNS = ["search_path", "emb_mode", "emb_backend", "pipeline", "llm_cache_mode", "reason", "exception"]
+BOOL_COLUMNS = ["q_cache_hit", "llm_cache_hit", "answer_cache_hit", "retrieval_only"]
+METRIC_COLUMNS = INT_COLUMNS + REAL_COLUMNS + TEXT_COLUMNS + BOOL_COLUMNS
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS query_log (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts         TEXT NOT NULL,
+    run_id     TEXT,
+    query      TEXT NOT NULL,
+    filters    TEXT NOT NULL,
+    step       TEXT NOT NULL,
+    status     TEXT NOT NULL,
+    top_codes  TEXT,
+    {", ".join(f"{c} INTEGER" for c in INT_COLUMNS + BOOL_COLUMNS)},
+    {", ".join(f"{c} REAL" for c in REAL_COLUMNS)},
+    {", ".join(f"{c} TEXT" for c in TEXT_COLUMNS)},
+    extra_json TEXT
+);
+CREATE INDEX IF NOT EXISTS query_log_ts ON query_log (ts);
+CREATE INDEX IF NOT EXISTS query_log_query ON query_log (query, filters);
+CREATE INDEX IF NOT EXISTS query_log_filters ON query_log (filters);
+CREATE INDEX IF NOT EXISTS query_log_run ON query_log (run_id, ts);
+"""
+
+INSERT_COLUMNS = ["ts", "run_id", "query", "filters", "step", "status", "top_codes"] + METRIC_COLUMNS + ["extra_json"]
+
+
+def _typed(col: str, v: Any) -> Any:
+    if v is None:
+        return None
+    try:
+        if col in INT_COLUMNS:
+            return int(v)
+        if col in REAL_COLUMNS:
+            return float(v)
+        if col in BOOL_COLUMNS:
+            return int(bool(v))
+    except (TypeError, ValueError):
+        return None
+    return str(v)
+
+
+def encode_codes(codes: Any) -> str | None:
+    return json.dumps([str(c) for c in codes], ensure_ascii=False) if isinstance(codes, list) else None
+
+
+def decode_codes(value: Any) -> list[str]:
+    # NULL comes back as None or NaN depending on the pandas version
+    if not isinstance(value, str) or not value:
+        return []
+    return [str(c) for c in json.loads(value)]
+
+
+def make_record(ts: str, query: str, filters: str, step: str, status: str, details: dict[str, Any],
+                run_id: str | None = None) -> dict[str, Any]:
+    """log_attempt() arguments -> one query_log row (details split into columns + extra_json)."""
+    rest = dict(details)
+    codes = rest.pop("top_codes", None)
+    rec: dict[str, Any] = {
+        "ts": ts, "run_id": run_id, "query": query, "filters": filters, "step": step, "status": status,
+        "top_codes": encode_codes(codes),
+    }
+    for col in METRIC_COLUMNS:
+        rec[col] = _typed(col, rest.pop(col, None))
+    rec["extra_json"] = json.dumps(rest, ensure_ascii=False, default=str) if rest else None
+    return rec
+
+
+class QueryLogStore:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as con:
+            con.execute("PRAGMA journal_mode=WAL")
+            con.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # one short-lived connection per call (one transaction), as in llm_cache.py
+        con = sqlite3.connect(self.path, timeout=30)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def write_rows(self, records: list[dict[str, Any]]) -> None:
+        """Batch insert in one transaction (log_writer.CSVLogWriter sink interface)."""
+        sql = f"INSERT INTO query_log ({', '.join(INSERT_COLUMNS)}) VALUES ({', '.join('?' * len(INSERT_COLUMNS))})"
+        with self._connect() as con:
+            con.executemany(sql, [[r.get(c) for c in INSERT_COLUMNS] for r in records])
+
+    def count(self) -> int:
+        with self._connect() as con:
+            return int(con.execute("SELECT COUNT(*) FROM query_log").fetchone()[0])
+
+
+def _finish_frame(df: pd.DataFrame) -> pd.DataFrame:
+    df["top_codes"] = [decode_codes(v) for v in df["top_codes"]]
+    for col in BOOL_COLUMNS:
+        df[col] = df[col].fillna(0).astype(bool)
+    for col in INT_COLUMNS:
+        df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
+    for col in REAL_COLUMNS:
+        df[col] = pd.to_numeric(df[col], errors="coerce")
+    return df
+
+
+def read_log(path: Path, run_id: str | None = None, since: str | None = None, until: str | None = None,
+             status: str | None = None, step: str | None = None, live_only: bool = False) -> pd.DataFrame:
+    """
+    Rows of the store as a DataFrame, oldest first. since/until compare with Aeg
+    ("YYYY-MM-DD HH:MM:SS", prefixes work); live_only: only rows without run id.
+    """
+    where, args = [], []
+    if run_id is not None:
+        where.append("run_id = ?")
+        args.append(run_id)
+    elif live_only:
+        where.append("run_id IS NULL")
+    if since:
+        where.append("ts >= ?")
+        args.append(since)
+    if until:
+        where.append("ts < ?")
+        args.append(until)
+    if status:
+        where.append("status = ?")
+        args.append(status)
+    if step:
+        where.append("step = ?")
+        args.append(step)
+    cols = [f"{c} AS \"{BASE_COLUMNS[c]}\"" for c in BASE_COLUMNS] + ["run_id", "top_codes"] + METRIC_COLUMNS + ["extra_json"]
+    sql = f"SELECT {', '.join(cols)} FROM query_log"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY ts, id"
+    con = sqlite3.connect(path, timeout=30)
+    try:
+        df = pd.read_sql_query(sql, con, params=args)
+    finally:
+        con.close()
+    return _finish_frame(df)
+
+
+def frame_from_csv(csv_log: pd.DataFrame) -> pd.DataFrame:
+    """Old vigade_log.csv (DetailidJSON) -> the read_log() frame; the JSON is parsed once here."""
+    recs = []
+    for row in csv_log.fillna("").itertuples(index=False):
+        try:
+            details = json.loads(row.DetailidJSON) if str(row.DetailidJSON).strip() else {}
+        except ValueError:
+            details = {}
+        recs.append(make_record(str(row.Aeg), str(row.Päring), str(row.Filtrid), str(row.Samm),
+                                str(row.Tulemus), details if isinstance(details, dict) else {}))
+    df = pd.DataFrame(recs, columns=INSERT_COLUMNS).rename(columns=BASE_COLUMNS)
+    return _finish_frame(df)
+
+
+def load_log(db_path: Path, csv_path: Path | None = None, **filters: Any) -> pd.DataFrame:
+    """read_log(db_path) if the store exists, else frame_from_csv(csv_path). FileNotFoundError if neither."""
+    if Path(db_path).exists():
+        return read_log(db_path, **filters)
+    if csv_path is not None and Path(csv_path).exists():
+        return frame_from_csv(pd.read_csv(csv_path))
+    raise FileNotFoundError(f"{db_path} / {csv_path}")
+
+
+def to_csv_layout(df: pd.DataFrame) -> pd.DataFrame:
+    """read_log() frame -> the vigade_log.csv layout (DetailidJSON rebuilt from the non-null columns)."""
+    details = []
+    for rec in df.to_dict("records"):
+        d: dict[str, Any] = {}
+        for col in ["top_codes"] + METRIC_COLUMNS:
+            v = rec.get(col)
+            if col in BOOL_COLUMNS:
+                if v:
+                    d[col] = True
+            elif col == "top_codes":
+                if v:
+                    d[col] = list(v)
+            elif v is not None and not pd.isna(v):
+                v = v.item() if hasattr(v, "item") else v
+                d[col] = int(v) if col in INT_COLUMNS else v
+        extra = rec.get("extra_json")
+        if isinstance(extra, str) and extra:  # NULL is None or NaN depending on the pandas version
+            d.update(json.loads(extra))
+        details.append(json.dumps(d, ensure_ascii=False))
+    out = df[list(BASE_COLUMNS.values())].copy()
+    out["DetailidJSON"] = details
+    return out[CSV_COLUMNS]
+
+
+def export_csv(db_path: Path, out_csv: Path, **filters: Any) -> int:
+    """Writes (a slice of) the store as vigade_log.csv. Returns the row count."""
+    df = to_csv_layout(read_log(db_path, **filters))
+    df.to_csv(out_csv, index=False)
+    return len(df)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Query log store: CSV export / import")
+    ap.add_argument("action", choices=["export", "import"])
+    ap.add_argument("csv", type=Path)
+    ap.add_argument("--db", type=Path, default=Path(__file__).parent / "out" / "query_log.sqlite")
+    ap.add_argument("--run-id")
+    ap.add_argument("--since")
+    ap.add_argument("--until")
+    args = ap.parse_args()
+
+    if args.action == "export":
+        if not args.db.exists():
+            raise SystemExit(f"Puudub: {args.db}")
+        n = export_csv(args.db, args.csv, run_id=args.run_id, since=args.since, until=args.until)
+        print(f"Valmis: {args.csv} ({n} rida)")
+    else:
+        if not args.csv.exists():
+            raise SystemExit(f"Puudub: {args.csv}")
+        df = frame_from_csv(pd.read_csv(args.csv)).rename(columns={v: k for k, v in BASE_COLUMNS.items()})
+        df["top_codes"] = [encode_codes(list(c)) if c else None for c in df["top_codes"]]
+        for col in BOOL_COLUMNS:
+            df[col] = df[col].astype(int)
+        recs = df.astype(object).where(df.notna(), None).to_dict("records")
+        store = QueryLogStore(args.db)
+        store.write_rows(recs)
+        print(f"Valmis: {args.db} (+{len(recs)} rida, kokku {store.count()})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+"""
+Query-time retrieval helpers shared by run_chatbot.py and the analysis scripts.
+
+FilterIndex: metadata filters (credits / semester / language / study level) are
+precomputed once into packed bitsets, one per distinct value, aligned to
+meta_df row order. A query's filter is then an AND of at most four bitsets.
+
+QueryEmbeddingCache: LRU of query vectors in front of embedder.encode, keyed on
+sanitize_user_text(prompt) (the chat path and Retriever share entries).
+
+apply_residency: memmap / warm (page-cache pre-read) / resident (float32 in RAM, optional mlock).
+
+Retriever.retrieve_batch: many prompts at once - one batched encode, queries
+grouped by identical filters, one (docs x queries) matmul per group.
+"""
+import ctypes
+import ctypes.util
+import os
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+import pandas as pd
+
+ANY_VALUES = {"", "ANY", "(kõik)"}
+SCORE_CHUNK = 4096
+# Filters keeping at least this share of all docs are scored with one contiguous pass
+# over the whole matrix (no fancy-index gather); narrower filters gather their rows.
+FULL_SCAN_MIN_SELECTIVITY = 0.75
+FILTER_KEYS = ("credits", "semester", "language", "level")
+RESIDENCY_MODES = ("memmap", "warm", "resident")
+
+
+def sanitize_user_text(s: str, max_len: int = 2000) -> str:
+    s = (s or "").replace("\x00", "")
+    s = re.sub(r"[\u0000-\u001f\u007f]", " ", s)  # control chars
+    s = re.sub(r"\s+", " ", s).strip()
+    return s[:max_len]
+
+
+def is_any(x: Any) -> bool:
+    return x is None or str(x).strip() in ANY_VALUES
+
+
+def parse_filters_str(filters_str: str) -> dict[str, str]:
+    out: dict[str, str] = {}
+    for part in str(filters_str).split(","):
+        if "=" in part:
+            k, v = part.split("=", 1)
+            out[k.strip()] = v.strip()
+    return out
+
+
+def filters_key(filters: str | dict[str, Any] | None) -> tuple[str | None, ...]:
+    """(credits, semester, language, level) with None for "any"; extra keys (faculty=...) are ignored."""
+    if filters is None:
+        filters = {}
+    elif isinstance(filters, str):
+        filters = parse_filters_str(filters)
+    return tuple(None if is_any(filters.get(k)) else str(filters.get(k)).strip() for k in FILTER_KEYS)
+
+
+def split_levels(s: str) -> list[str]:
+    parts = []
+    for p in str(s).replace(",", ";").split(";"):
+        p = p.strip()
+        if p:
+            parts.append(p)
+    return parts
+
+
+def _packed_masks(keys: np.ndarray) -> dict[Any, np.ndarray]:
+    """One packed boolean mask per distinct value in `keys` (object array)."""
+    out: dict[Any, np.ndarray] = {}
+    codes, uniq = pd.factorize(pd.Series(keys, dtype=object), use_na_sentinel=True)
+    for code, value in enumerate(uniq):
+        out[value] = np.packbits(codes == code)
+    return out
+
+
+class FilterIndex:
+    """
+    Bitset index over meta_df rows. Same matching rules as the old per-query pandas filters:
+    - credits: numeric equality if the filter value parses as a number, else stripped string equality
+    - semester / language: stripped string equality
+    - level: case-insensitive membership in split_levels(...)
+    """
+
+    def __init__(self, meta_df: pd.DataFrame, credits_col: str | None, semester_col: str | None,
+                 lang_col: str | None, level_col: str | None):
+        self.n = int(len(meta_df))
+        self.has_credits = credits_col is not None
+        self.has_semester = semester_col is not None
+        self.has_lang = lang_col is not None
+        self.has_level = level_col is not None
+
+        self.credits_num: dict[Any, np.ndarray] = {}
+        self.credits_str: dict[Any, np.ndarray] = {}
+        self.semester: dict[Any, np.ndarray] = {}
+        self.language: dict[Any, np.ndarray] = {}
+        self.level: dict[str, np.ndarray] = {}
+
+        if credits_col:
+            col = meta_df[credits_col]
+            num = pd.to_numeric(col, errors="coerce").astype(float).to_numpy()
+            self.credits_num = _packed_masks(num)
+            self.credits_str = _packed_masks(col.astype(str).str.strip().to_numpy(dtype=object))
+
+        if semester_col:
+            self.semester = _packed_masks(meta_df[semester_col].astype(str).str.strip().to_numpy(dtype=object))
+
+        if lang_col:
+            self.language = _packed_masks(meta_df[lang_col].astype(str).str.strip().to_numpy(dtype=object))
+
+        if level_col:
+            raw = meta_df[level_col].fillna("").astype(str).str.lower().tolist()
+            rows_by_level: dict[str, list[int]] = {}
+            for i, s in enumerate(raw):
+                for lv in split_levels(s):
+                    rows_by_level.setdefault(lv.lower(), []).append(i)
+            for lv, rows in rows_by_level.items():
+                m = np.zeros(self.n, dtype=bool)
+                m[rows] = True
+                self.level[lv] = np.packbits(m)
+
+        self._empty = np.zeros((self.n + 7) // 8, dtype=np.uint8)
+
+    def _credits_mask(self, value: Any) -> np.ndarray:
+        tgt = pd.to_numeric(pd.Series([value]), errors="coerce").iloc[0]
+        if pd.notna(tgt):
+            return self.credits_num.get(float(tgt), self._empty)
+        return self.credits_str.get(str(value).strip(), self._empty)
+
+    def mask(self, credits: Any = None, semester: Any = None, language: Any = None,
+             level: Any = None) -> np.ndarray | None:
+        """Packed mask for a filter combination; None means "no active filter" (all rows)."""
+        parts = []
+        if self.has_credits and not is_any(credits):
+            parts.append(self._credits_mask(credits))
+        if self.has_semester and not is_any(semester):
+            parts.append(self.semester.get(str(semester).strip(), self._empty))
+        if self.has_lang and not is_any(language):
+            parts.append(self.language.get(str(language).strip(), self._empty))
+        if self.has_level and not is_any(level):
+            parts.append(self.level.get(str(level).strip().lower(), self._empty))
+
+        if not parts:
+            return None
+        out = parts[0].copy()
+        for p in parts[1:]:
+            np.bitwise_and(out, p, out=out)
+        return out
+
+    def rows(self, credits: Any = None, semester: Any = None, language: Any = None,
+             level: Any = None) -> np.ndarray:
+        """meta_df row positions (int64) that pass the filters."""
+        packed = self.mask(credits, semester, language, level)
+        if packed is None:
+            return np.arange(self.n, dtype=np.int64)
+        return np.flatnonzero(np.unpackbits(packed, count=self.n)).astype(np.int64)
+
+
+def build_meta_to_emb(meta_ids: pd.Series, id_to_idx: dict[str, int]) -> np.ndarray:
+    """int64 join array: meta_df row -> embedding row, -1 where the course has no document."""
+    mapped = meta_ids.astype(str).map(id_to_idx)
+    mapped[meta_ids.isna().to_numpy()] = np.nan
+    return mapped.fillna(-1).to_numpy(dtype=np.int64)
+
+
+def emb_rows_for(meta_to_emb: np.ndarray, meta_rows: np.ndarray) -> np.ndarray:
+    """Filtered meta rows -> unique embedding rows (one vectorized take, no id hashing)."""
+    idxs = meta_to_emb.take(meta_rows)
+    return np.unique(idxs[idxs >= 0])
+
+
+class QueryEmbeddingCache:
+    """
+    Process-wide bounded LRU of query vectors keyed by (model, sanitized prompt).
+    Thread-safe, because Streamlit runs every session on its own thread.
+    """
+
+    def __init__(self, maxsize: int = 2048):
+        self.maxsize = int(maxsize)
+        self._data: OrderedDict[tuple[str, str], np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, model: str, text: str, encode: Callable[[str], np.ndarray]) -> tuple[np.ndarray, bool]:
+        """Returns (float32 vector, cache_hit). `encode` is only called on a miss."""
+        vec = self.peek(model, text)
+        if vec is not None:
+            return vec, True
+        return self.put(model, text, encode(text)), False
+
+    def peek(self, model: str, text: str) -> np.ndarray | None:
+        """Lookup without encoding (counts as hit/miss)."""
+        key = (model, text)
+        with self._lock:
+            vec = self._data.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return vec
+
+    def put(self, model: str, text: str, vec: np.ndarray) -> np.ndarray:
+        vec = np.array(vec, dtype=np.float32)
+        vec.setflags(write=False)  # shared between sessions
+        key = (model, text)
+        with self._lock:
+            self._data[key] = vec
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return vec
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
+
+
+def _mlock(arr: np.ndarray) -> bool:
+    """Pin arr in RAM (no swap-out). False if libc/mlock is unavailable or RLIMIT_MEMLOCK is too low."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        return libc.mlock(ctypes.c_void_p(arr.ctypes.data), ctypes.c_size_t(arr.nbytes)) == 0
+    except Exception:
+        return False
+
+
+def apply_residency(mm: np.ndarray, path: Path, mode: str, mlock: bool = False,
+                    chunk_bytes: int = 16 << 20) -> tuple[np.ndarray, dict[str, Any]]:
+    """
+    memmap:   return mm as-is (pages fault in on first queries, f16->f32 per query)
+    warm:     pre-read the file sequentially so the page cache is hot, still return mm
+    resident: contiguous float32 copy with re-normalized rows (no upcast at query time), optionally mlocked
+    """
+    if mode not in RESIDENCY_MODES:
+        raise ValueError(f"Unknown residency mode: {mode} (expected one of {RESIDENCY_MODES})")
+    info: dict[str, Any] = {"emb_mode": mode}
+
+    if mode == "warm":
+        with open(path, "rb") as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while f.read(chunk_bytes):
+                pass
+        return mm, info
+
+    if mode == "resident":
+        arr = np.ascontiguousarray(mm, dtype=np.float32)
+        norms = np.linalg.norm(arr, axis=1, keepdims=True)
+        np.divide(arr, np.maximum(norms, 1e-12), out=arr)
+        arr.setflags(write=False)
+        if mlock:
+            info["emb_mlocked"] = _mlock(arr)
+        return arr, info
+
+    return mm, info
+
+
+def score_rows(doc_embs: np.ndarray, idxs: np.ndarray, Q: np.ndarray, chunk: int = SCORE_CHUNK) -> np.ndarray:
+    """
+    (len(idxs) x n_queries) float32 scores of embedding rows `idxs` against query matrix Q.
+    Rows are gathered chunk by chunk so RAM stays stable; each chunk is one matmul for all queries.
+    """
+    Q = np.asarray(Q, dtype=np.float32).reshape(-1, doc_embs.shape[1])
+    out = np.empty((len(idxs), len(Q)), dtype=np.float32)
+    for start in range(0, len(idxs), chunk):
+        part = idxs[start : start + chunk]
+        out[start : start + len(part)] = doc_embs[part].astype(np.float32, copy=False) @ Q.T
+    return out
+
+
+def score_all(doc_embs: np.ndarray, Q: np.ndarray, chunk: int = SCORE_CHUNK) -> np.ndarray:
+    """(n_docs x n_queries) scores from contiguous slices of the matrix (sequential reads, no gather)."""
+    Q = np.asarray(Q, dtype=np.float32).reshape(-1, doc_embs.shape[1])
+    n = int(doc_embs.shape[0])
+    out = np.empty((n, len(Q)), dtype=np.float32)
+    for start in range(0, n, chunk):
+        out[start : start + chunk] = doc_embs[start : start + chunk].astype(np.float32, copy=False) @ Q.T
+    return out
+
+
+def scores_for(doc_embs: np.ndarray, idxs: np.ndarray, Q: np.ndarray,
+               full_min: float = FULL_SCAN_MIN_SELECTIVITY) -> tuple[np.ndarray, str, float]:
+    """
+    Scores of rows `idxs`, path picked from filter selectivity (= len(idxs) / n_docs):
+    broad -> score_all + mask to idxs ("full"), narrow -> gather only idxs ("gather").
+    Returns (scores (len(idxs) x n_queries), path, selectivity).
+    """
+    n = int(doc_embs.shape[0])
+    selectivity = len(idxs) / n if n else 0.0
+    if len(idxs) and selectivity >= full_min:
+        return score_all(doc_embs, Q)[idxs], "full", selectivity
+    return score_rows(doc_embs, idxs, Q), "gather", selectivity
+
+
+def top_k_positions(scores: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the k best scores, best first."""
+    k = min(int(k), len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    pos = np.argpartition(scores, -k)[-k:]
+    return pos[np.argsort(scores[pos])[::-1]]
+
+
+class Retriever:
+    """Bundles the loaded index so bulk workloads (analysis, evaluation) can retrieve in batches."""
+
+    def __init__(self, embedder: Any, model_name: str, doc_embs: np.ndarray, doc_ids: list[str],
+                 filter_index: FilterIndex, meta_to_emb: np.ndarray,
+                 query_cache: QueryEmbeddingCache | None = None, batch_size: int = 64,
+                 full_min: float = FULL_SCAN_MIN_SELECTIVITY):
+        self.embedder = embedder
+        self.model_name = model_name
+        self.doc_embs = doc_embs
+        self.doc_ids = doc_ids
+        self.filter_index = filter_index
+        self.meta_to_emb = meta_to_emb
+        self.query_cache = query_cache
+        self.batch_size = int(batch_size)
+        self.full_min = float(full_min)
+
+    def encode_batch(self, prompts: list[str]) -> np.ndarray:
+        """All prompts in one embedder.encode call (cached vectors are reused, misses encoded together)."""
+        prompts = [sanitize_user_text(p) for p in prompts]
+        dim = int(self.doc_embs.shape[1])
+        Q = np.empty((len(prompts), dim), dtype=np.float32)
+        todo = list(range(len(prompts)))
+        if self.query_cache is not None:
+            todo = []
+            for i, p in enumerate(prompts):
+                vec = self.query_cache.peek(self.model_name, p)
+                if vec is None:
+                    todo.append(i)
+                else:
+                    Q[i] = vec
+        if todo:
+            embs = self.embedder.encode(
+                [prompts[i] for i in todo],
+                batch_size=self.batch_size,
+                normalize_embeddings=True,
+            )
+            embs = np.asarray(embs, dtype=np.float32)
+            Q[todo] = embs
+            if self.query_cache is not None:
+                for i, vec in zip(todo, embs):
+                    self.query_cache.put(self.model_name, prompts[i], vec)
+        return Q
+
+    def retrieve_batch(self, prompts: list[str], filters_list: list[str | dict[str, Any] | None],
+                       k: int) -> list[dict[str, Any]]:
+        """
+        Per prompt: {"ids", "rows", "scores", "filtered_count", "docs_scored", "search_path", "selectivity"},
+        ranked best first.
+        filters_list items are filter strings ("credits=3, semester=autumn, ...") or dicts.
+        """
+        if len(prompts) != len(filters_list):
+            raise ValueError("prompts and filters_list must have the same length")
+
+        Q = self.encode_batch(list(prompts))
+
+        groups: dict[tuple[str | None, ...], list[int]] = {}
+        for i, f in enumerate(filters_list):
+            groups.setdefault(filters_key(f), []).append(i)
+
+        results: list[dict[str, Any]] = [{} for _ in prompts]
+        for key, qpos in groups.items():
+            meta_rows = self.filter_index.rows(*key)
+            idxs = emb_rows_for(self.meta_to_emb, meta_rows)
+            scores, path, selectivity = scores_for(self.doc_embs, idxs, Q[qpos], self.full_min)
+            for j, qi in enumerate(qpos):
+                top = top_k_positions(scores[:, j], k)
+                rows = idxs[top]
+                results[qi] = {
+                    "ids": [self.doc_ids[r] for r in rows],
+                    "rows": rows,
+                    "scores": scores[top, j],
+                    "filtered_count": int(len(meta_rows)),
+                    "docs_scored": int(len(idxs)),
+                    "search_path": f"batch_{path}",
+                    "selectivity": round(selectivity, 4),
+                }
+        return results
@@ -0,0 +1,158 @@
+"""async_runner: bounded concurrency, retries, rate limiting and cancellation (no network, fake coroutines)."""
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from async_runner import TokenBucket, is_retryable, run_bounded, with_retries  # noqa: E402
+
+
+class FakeAPIError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class APIConnectionError(Exception):
+    pass
+
+
+def flaky(failures: list[BaseException], result: str = "ok"):
+    """Coroutine factory that raises the given errors in order, then returns `result`."""
+    calls = {"n": 0}
+
+    async def fn() -> str:
+        calls["n"] += 1
+        if failures:
+            raise failures.pop(0)
+        return result
+
+    return fn, calls
+
+
+def test_is_retryable():
+    assert is_retryable(FakeAPIError(429))
+    assert is_retryable(FakeAPIError(503))
+    assert not is_retryable(FakeAPIError(400))
+    assert not is_retryable(FakeAPIError(401))
+    assert is_retryable(APIConnectionError())
+    assert is_retryable(TimeoutError())
+    assert not is_retryable(ValueError())
+
+
+def test_retries_429_and_5xx_until_success():
+    fn, calls = flaky([FakeAPIError(429), FakeAPIError(502)])
+    result, retries = asyncio.run(with_retries(fn, retries=3, base_delay=0.001))
+    assert (result, retries, calls["n"]) == ("ok", 2, 3)
+
+
+def test_gives_up_after_max_retries():
+    fn, calls = flaky([FakeAPIError(503)] * 5)
+    with pytest.raises(FakeAPIError):
+        asyncio.run(with_retries(fn, retries=2, base_delay=0.001))
+    assert calls["n"] == 3
+
+
+def test_non_retryable_error_is_raised_at_once():
+    fn, calls = flaky([FakeAPIError(400)])
+    with pytest.raises(FakeAPIError):
+        asyncio.run(with_retries(fn, retries=3, base_delay=0.001))
+    assert calls["n"] == 1
+
+
+def test_token_bucket_paces_requests():
+    rate, n = 50.0, 6
+
+    async def run() -> float:
+        bucket = TokenBucket(rate, burst=1)
+        t = time.monotonic()
+        for _ in range(n):
+            await bucket.acquire()
+        return time.monotonic() - t
+
+    # first token is there at start, the other n - 1 arrive at `rate` per second
+    assert asyncio.run(run()) >= (n - 1) / rate * 0.9
+
+
+def test_token_bucket_burst_is_immediate():
+    async def run() -> float:
+        bucket = TokenBucket(1.0, burst=3)
+        t = time.monotonic()
+        for _ in range(3):
+            await bucket.acquire()
+        return time.monotonic() - t
+
+    assert asyncio.run(run()) < 0.1
+
+
+def test_retries_go_through_the_limiter():
+    fn, calls = flaky([FakeAPIError(429)] * 2)
+
+    async def run() -> tuple[str, int, float]:
+        bucket = TokenBucket(20.0, burst=1)
+        t = time.monotonic()
+        result, retries = await with_retries(fn, retries=3, base_delay=0.0, limiter=bucket)
+        return result, retries, time.monotonic() - t
+
+    result, retries, elapsed = asyncio.run(run())
+    assert (result, retries, calls["n"]) == ("ok", 2, 3)
+    assert elapsed >= 2 / 20.0 * 0.9
+
+
+def test_run_bounded_limits_concurrency_and_keeps_order():
+    state = {"in_flight": 0, "peak": 0}
+    seen = []
+
+    async def worker(i: int) -> int:
+        state["in_flight"] += 1
+        state["peak"] = max(state["peak"], state["in_flight"])
+        await asyncio.sleep(0.01 * (i % 3))
+        state["in_flight"] -= 1
+        return i * i
+
+    def progress(done: int, total: int, elapsed: float, eta: float):
+        seen.append((done, total))
+
+    out = asyncio.run(run_bounded(list(range(10)), worker, 3, progress))
+    assert out == [i * i for i in range(10)]
+    assert state["peak"] == 3
+    assert seen[-1] == (10, 10) and [d for d, _ in seen] == list(range(1, 11))
+
+
+def test_cancel_stops_in_flight_and_queued_workers():
+    started, finished = [], []
+
+    async def worker(i: int) -> int:
+        started.append(i)
+        await asyncio.sleep(10)
+        finished.append(i)
+        return i
+
+    async def run():
+        task = asyncio.create_task(run_bounded(list(range(8)), worker, 2))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert sorted(started) == [0, 1]
+    assert finished == []
+
+
+def test_cancel_during_backoff():
+    fn, calls = flaky([FakeAPIError(503)] * 5)
+
+    async def run():
+        task = asyncio.create_task(with_retries(fn, retries=5, base_delay=10.0))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(run())
+    assert calls["n"] == 1